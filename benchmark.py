@@ -0,0 +1,86 @@
+#################################################################
+# Checks that simulating every network in the settings file in
+# one pass gives the same results as one network at a time, by
+# default over 2020-2030 at the first threshold, and times both.
+# Usage: python benchmark.py settings.dat
+#################################################################
+import argparse
+import copy
+import time
+from datetime import datetime
+from os import chdir, getcwd
+from tempfile import mkdtemp
+
+import settings
+import simulate
+
+
+def compare_networks(settings_file, start, end, seed):
+    """
+    Simulates every network in the settings file at its first threshold, once in one pass with
+    simulate.simulate_networks, sharing the night and moon tables and transit catalogue, and once a network at a time
+    with nothing shared, and compares each network's results
+    :param settings_file: Location of the settings file
+    :param start: Start of the runs: datetime
+    :param end: End of the runs: datetime
+    :param seed: Seed for the random number generator of every run
+    :return: Whether every network's results are the same: boolean
+    """
+    base = settings.Settings(settings_file)
+    networks = base.telescopes
+    base.threshold_value = base.threshold_value[0]
+    base.start, base.end = start, end
+    base.seed = seed
+
+    results, timings = {}, {}
+    working_dir = getcwd()
+    for shared in [True, False]:
+        starting_dir = mkdtemp(prefix=f'benchmark_{"networks" if shared else "single"}_')
+        chdir(starting_dir)
+        t0 = time.perf_counter()
+        if shared:
+            simulate.simulate_networks(copy.deepcopy(base), starting_dir, 1, networks, [base.threshold_value])
+        else:
+            for network in networks:
+                setting_data = copy.deepcopy(base)  # a fresh copy, so no tables are carried between networks
+                setting_data.telescopes = network
+                simulate.simulate(setting_data, starting_dir, 1)
+        timings[shared] = time.perf_counter() - t0
+        chdir(working_dir)
+        for network in networks:
+            setting_data = copy.deepcopy(base)
+            setting_data.telescopes = network
+            setting_data.obtain_directory_single()
+            with open(f'{starting_dir}/{setting_data.directory}/results.csv') as f:
+                results[(network, shared)] = f.readline().strip()
+
+    same = True
+    print('#Network, Match, Performance(%), TotalObservations, TotalObsDays, TotalNightDays, PercentNightUsed, '
+          'PercentClearUsed')
+    for network in networks:
+        match = results[(network, True)] == results[(network, False)]
+        same = same and match
+        print(f'{network}, {"Y" if match else "N"}, {results[(network, True)]}')
+        if not match:
+            print(f'{network}, single, {results[(network, False)]}')
+    print(f'One pass {timings[True]:.1f}s, one network at a time {timings[False]:.1f}s, '
+          f'results {"match" if same else "differ"}')
+    return same
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check and time simulating every network in one pass')
+    parser.add_argument('settings', help='Settings file to take the networks, threshold and data location from')
+    parser.add_argument('-st', default='2020-01-01', help='Start date, format "YYYY-mm-dd"')
+    parser.add_argument('-ed', default='2030-01-01', help='End date, format "YYYY-mm-dd"')
+    parser.add_argument('-seed', type=int, default=1, help='Seed for the random number generator')
+    args = parser.parse_args()
+    start = datetime.strptime(args.st, '%Y-%m-%d')
+    end = datetime.strptime(args.ed, '%Y-%m-%d')
+
+    if not compare_networks(args.settings, start, end, args.seed):
+        raise Exception
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,348 @@
+#################################################################
+# Catalogue of the transits of every target at every site over
+# a span of years, for the ephemerides in a target database.
+# The geometry of each transit, night, target rise and set and
+# moon, is calculated once by the build step and written to a
+# memory mapped file shared by every run and process, which
+# then only applies the settings dependent checks.
+# Usage: python catalog.py settings.dat
+#################################################################
+import argparse
+from datetime import datetime
+from os import makedirs, path, replace
+
+import numpy as np
+
+import ephemeris
+import mini_staralt
+import settings
+import timeconv
+import tools
+from target import forecast_centers
+
+# one row per transit and site where the transit center is at night with the target up
+ROW_DTYPE = np.dtype([('target', 'i4'), ('epoch', 'i8'), ('site', 'i2'), ('center', 'f8'),
+                      ('sunset', 'f8'), ('sunrise', 'f8'), ('target_rise', 'f8'), ('target_set', 'f8'),
+                      ('visible_from', 'f8'), ('visible_until', 'f8'), ('moon_phase', 'f8'), ('moon_alt', 'f8')])
+
+
+class TransitCatalog:
+    """
+    Transits of a list of targets at a list of sites between two dates, for the ephemerides the catalogue was built
+    from. Only the checks that do not depend on the settings are applied when building, the transit center at night
+    with the target above 30 degrees, so the gress and moon checks are made when reading. Rows are held in a memory
+    mapped file sorted by target, then epoch and site, so the transits of a target in a window are a slice of it
+    """
+    def __init__(self):
+        """
+        Null constructor
+        """
+        self.rows = None
+        self.names = []
+        self.index = {}  # target name to position in names
+        self.offsets = None  # first row of each target, and the end of the last
+        self.last_tmid = None
+        self.period = None
+        self.last_epoch = None
+        self.sites = []
+        self.lats = None
+        self.lons = None
+        self.start = None
+        self.end = None
+        self.tolerance = 0.  # days
+        self.served = 0
+        self.fallbacks = 0
+
+    def __str__(self):
+        return f'Transit catalogue: {self.served} forecasts read, {self.fallbacks} calculated directly'
+
+    def build(self, targets, telescopes, start, end, mintargetalt=30, sundown=-20, nights=None, moon=None):
+        """
+        Calculates the transits of the targets between the dates given at each telescope, using the current ephemeris
+        of each target
+        :param targets: List of Target objects
+        :param telescopes: List of Telescope objects, one per site
+        :param start: Start of the catalogue: datetime
+        :param end: End of the catalogue: datetime
+        :param mintargetalt: Minimum target altitude in degrees: float
+        :param sundown: Sun altitude defining night in degrees: float
+        :param nights: Night table covering the sites and dates at sundown, built here if not given: NightEphemeris
+        :param moon: Moon grid covering the dates, built here if not given: MoonEphemeris
+        :return: Filled TransitCatalog object
+        """
+        self.names = [single.name for single in targets]
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.last_tmid = np.array([single.last_tmid for single in targets], dtype=float)
+        self.period = np.array([single.period for single in targets], dtype=float)
+        self.last_epoch = np.array([single.last_epoch for single in targets], dtype=int)
+        self.sites = [telescope.name for telescope in telescopes]
+        self.lats = np.array([telescope.lat for telescope in telescopes], dtype=float)
+        self.lons = np.array([telescope.lon for telescope in telescopes], dtype=float)
+        self.start, self.end = timeconv.to_mjd(start), timeconv.to_mjd(end)
+
+        if nights is None:
+            nights = ephemeris.NightEphemeris().build(telescopes, start, end, sundowns=(sundown,))
+        if moon is None:
+            moon = ephemeris.MoonEphemeris().build(start, end)
+        index, epochs, centers = forecast_centers(self.last_tmid, self.period, self.last_epoch, self.start, self.end)
+        jd = centers + timeconv.MJD_OFFSET
+        moon_phase = np.array([round(phase, 3) for phase in moon.get_phase(jd).tolist()])
+        moon_ra, moon_dec = moon.get_position(jd)
+
+        parts = []
+        for site, telescope in enumerate(telescopes):
+            night_site = nights.sites.index(telescope.name)
+            for single in targets:
+                single.obtain_rise_set_lst([telescope], mintargetalt)
+            rise_lst = np.array([single.rise_set_lst[telescope.name][0] for single in targets])[index]
+            up_hours = np.array([single.rise_set_lst[telescope.name][1] for single in targets])[index]
+
+            # sunset and sunrise either side of the center, stepping back a night where the center is before sunset
+            night = np.round(np.floor(centers - 0.5) + 0.5 - nights.start_mjd).astype(int)
+            sunset = nights.sunset[float(sundown)][night_site, night]
+            night = np.where(sunset > centers, night - 1, night)
+            sunset = nights.sunset[float(sundown)][night_site, night]
+            sunrise = nights.sunrise[float(sundown)][night_site, night]
+
+            # most recent rise above the minimum altitude at or before the center, and the following set
+            since_rise, up_solar = mini_staralt.get_last_rise(jd, rise_lst, up_hours, telescope.lon)
+            target_rise = np.where(up_hours >= 24, sunset, centers - since_rise / 24)
+            target_set = np.where(up_hours >= 24, sunrise, target_rise + up_solar / 24)
+            visible_from = np.where(sunset >= target_rise, sunset, target_rise)
+            visible_until = np.where(sunrise <= target_set, sunrise, target_set)
+
+            keep = (up_hours > 0) & (sunset < centers) & (centers < sunrise) & (visible_from < centers) & (
+                    centers < visible_until)
+            part = np.empty(np.count_nonzero(keep), dtype=ROW_DTYPE)
+            part['target'], part['epoch'], part['site'], part['center'] = index[keep], epochs[keep], site, centers[keep]
+            part['sunset'], part['sunrise'] = sunset[keep], sunrise[keep]
+            part['target_rise'], part['target_set'] = target_rise[keep], target_set[keep]
+            part['visible_from'], part['visible_until'] = visible_from[keep], visible_until[keep]
+            part['moon_phase'] = moon_phase[keep]
+            part['moon_alt'] = mini_staralt.get_alt(jd[keep], moon_ra[keep], moon_dec[keep], telescope.lon,
+                                                    telescope.lat)
+            parts.append(part)
+
+        rows = np.concatenate(parts)
+        self.rows = rows[np.lexsort((rows['site'], rows['epoch'], rows['target']))]
+        self.offsets = np.searchsorted(self.rows['target'], np.arange(len(targets) + 1))
+        return self
+
+    def save(self, directory):
+        """
+        Writes the catalogue to a directory, the rows as a .npy file that can be memory mapped and the index as a .npz
+        file, replacing any existing files atomically. The index is written last, so a reader never finds an index
+        for rows that are not there
+        :param directory: Location of the directory to write to
+        """
+        makedirs(directory, exist_ok=True)
+        rows_file, index_file = path.join(directory, 'transits.npy'), path.join(directory, 'index.npz')
+        np.save(rows_file + '.tmp.npy', self.rows)
+        replace(rows_file + '.tmp.npy', rows_file)
+        np.savez(index_file + '.tmp.npz', names=np.array(self.names), offsets=self.offsets,
+                 last_tmid=self.last_tmid, period=self.period, last_epoch=self.last_epoch,
+                 sites=np.array(self.sites), lats=self.lats, lons=self.lons, start=self.start, end=self.end,
+                 n_rows=len(self.rows))
+        replace(index_file + '.tmp.npz', index_file)
+
+    def load(self, directory, tolerance=0.):
+        """
+        Opens a catalogue written by save, memory mapping the rows so they are only read from disk when used and are
+        shared between processes reading the same file
+        :param directory: Location of the catalogue
+        :param tolerance: Largest difference in minutes between a target's forecast transit centers and those in the
+                          catalogue for the catalogue to be used, otherwise the transits are calculated directly: float
+        :return: Filled TransitCatalog object
+        """
+        with np.load(path.join(directory, 'index.npz')) as data:
+            self.names = [str(name) for name in data['names']]
+            self.offsets = data['offsets']
+            self.last_tmid = data['last_tmid']
+            self.period = data['period']
+            self.last_epoch = data['last_epoch']
+            self.sites = [str(site) for site in data['sites']]
+            self.lats = data['lats']
+            self.lons = data['lons']
+            self.start, self.end = float(data['start']), float(data['end'])
+            n_rows = int(data['n_rows'])
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.rows = np.load(path.join(directory, 'transits.npy'), mmap_mode='r').view(np.ndarray)  # still mapped
+        if len(self.rows) != n_rows:
+            print('Transit catalogue rows do not match its index, rebuild it')
+            raise Exception
+        self.tolerance = tolerance / 24 / 60
+        return self
+
+    def site_order(self, single, telescopes):
+        """
+        Position in the list of telescopes of each catalogue site, for the telescopes that can observe a target
+        :param single: Target object
+        :param telescopes: List of Telescope objects being checked
+        :return: Position of each site, -1 for sites not checked, or None if a telescope is not in the catalogue
+        """
+        order = [-1] * len(self.sites)
+        for position, telescope in enumerate(telescopes):
+            if telescope.name in single.observable_from:
+                if telescope.name not in self.sites:
+                    return None
+                site = self.sites.index(telescope.name)
+                if self.lats[site] != telescope.lat or self.lons[site] != telescope.lon:
+                    return None
+                order[site] = position
+        return order
+
+    def check_forecast_visibility(self, single, epochs, centers, telescopes, settings, table):
+        """
+        Adds the visible transits of a Target to a table from the catalogue, in the same order and with the same
+        values as Target.check_forecast_visibility, if the catalogue holds them. It does not for targets or sites not
+        in the catalogue, transits outside its dates, HIP41378, which is always scheduled, or where the target's
+        ephemeris has drifted from the catalogue's by more than the tolerance. Within the tolerance, the catalogue's
+        transits are moved to the forecast centers
+        :param single: Target object
+        :param epochs: Epochs of the transits: int array
+        :param centers: Transit centers: float MJD array
+        :param telescopes: List of Telescope objects to be checked for visibility
+        :param settings: Settings object for the current run
+        :param table: TransitTable to add the visible transits to
+        :return: Whether the transits were added from the catalogue: boolean
+        """
+        i = self.index.get(single.name)
+        if i is None or 'HIP41378' in single.name:
+            return False
+        if len(epochs) == 0:
+            return True
+        first_epoch, last_epoch = int(epochs[0]), int(epochs[-1])
+        centers = centers.tolist()
+        if first_epoch <= self.last_epoch[i] or centers[0] <= self.start or centers[-1] >= self.end:
+            self.fallbacks += 1
+            return False
+        # the drift is linear in epoch, so largest at one end
+        last_tmid, period, epoch = float(self.last_tmid[i]), float(self.period[i]), int(self.last_epoch[i])
+        drift = max(abs(centers[0] - (last_tmid + (first_epoch - epoch) * period)),
+                    abs(centers[-1] - (last_tmid + (last_epoch - epoch) * period)))
+        order = self.site_order(single, telescopes)
+        if drift > self.tolerance or order is None:
+            self.fallbacks += 1
+            return False
+        self.served += 1
+
+        # the target's rows are sorted by epoch, and the forecast epochs are consecutive
+        first, last = self.offsets[i], self.offsets[i + 1]
+        first, last = (first + np.searchsorted(self.rows['epoch'][first:last], [first_epoch, last_epoch + 1])).tolist()
+        rows = sorted((row for row in self.rows[first:last].tolist() if order[row[2]] >= 0),
+                      key=lambda row: (row[1], order[row[2]]))
+        stats = settings.visibility_stats
+        if stats is not None:
+            self.record_missing(single, telescopes, centers, len(rows), stats)
+
+        duration = single.duration / 24 / 60  # minutes to days
+        for (_, epoch, site, _, sunset, sunrise, target_rise, target_set, visible_from, visible_until, moon_phase,
+             moon_alt) in rows:
+            center = centers[epoch - first_epoch]
+            ingress, egress = center - duration / 2, center + duration / 2
+            ingress_visible = visible_from < ingress < visible_until
+            egress_visible = visible_from < egress < visible_until
+            if ingress_visible and egress_visible:
+                fraction = 1
+            elif settings.partial and ingress_visible:
+                fraction = np.round((visible_until - ingress) / duration, 2)
+            elif settings.partial and egress_visible:
+                fraction = np.round((egress - visible_from) / duration, 2)
+            else:
+                fraction = 0
+            if not visible_from < center < visible_until:  # checked again, as the center can drift within the tolerance
+                rejected = 'target_down'
+            elif fraction <= 0.55:
+                rejected = 'gress'
+            elif not (moon_phase > settings.moon_phase and moon_alt > settings.moon_alt):
+                rejected = 'moon'
+            else:
+                rejected = None
+            if stats is not None:
+                stats.record(rejected)
+            if rejected is not None:
+                continue
+            table.append_values((center, ingress, egress, duration, float(single.ra), float(single.dec),
+                                 float(single.depth), float(single.period), float(single.star_mag), sunset, sunrise,
+                                 target_rise, target_set, visible_from, visible_until, fraction, moon_phase, moon_alt,
+                                 epoch, 0, ingress_visible, egress_visible, False, single.name, self.sites[site]))
+        return True
+
+    @staticmethod
+    def record_missing(single, telescopes, centers, n_rows, stats):
+        """
+        Counts the candidate transits of a Target that are not in the catalogue in the visibility stats, as
+        Target.check_forecast_visibility would. Those on days of the year the seasonal visibility index rules out are
+        counted as rejected by season, and the rest by one of the never_up, daytime and target_down stages, which the
+        catalogue does not tell apart as it only holds the transits that passed them
+        :param single: Target object
+        :param telescopes: List of Telescope objects being checked
+        :param centers: Transit centers: list of float MJD
+        :param n_rows: Number of the target's transits read from the catalogue
+        :param stats: VisibilityStats object
+        """
+        days = ephemeris.day_of_year(centers)
+        candidates = 0
+        for telescope in telescopes:
+            if telescope.name in single.observable_from:
+                observable_days = single.observable_days.get(telescope.name)
+                observable = len(days) if observable_days is None else int(np.count_nonzero(observable_days[days]))
+                stats.record('season', len(days) - observable)
+                candidates += observable
+        stats.record('night_up', candidates - n_rows)
+
+
+def load_catalog(directory, tolerance=0.):
+    """
+    Opens the transit catalogue at the location given, or gives None if there isn't one there
+    :param directory: Location of the catalogue, or None
+    :param tolerance: Largest drift of a target's ephemeris from the catalogue's in minutes: float
+    :return: TransitCatalog object or None
+    """
+    if directory is None or not path.exists(path.join(directory, 'index.npz')):
+        if directory is not None:
+            print(f'No transit catalogue at {directory}, run catalog.py to build it')
+        return None
+    return TransitCatalog().load(directory, tolerance)
+
+
+def catalog_sites(data_root, networks):
+    """
+    Every site in the telescope networks given, once each
+    :param data_root: Location of the data directory holding /telescopes/
+    :param networks: Names of the telescope network .csv files
+    :return: List of Telescope objects
+    """
+    sites = {}
+    for network in networks:
+        for telescope in tools.load_telescopes(f'{data_root}/telescopes/{network}'):
+            known = sites.setdefault(telescope.name, telescope)
+            if known.lat != telescope.lat or known.lon != telescope.lon:
+                print(f'Site {telescope.name} is at different locations in different networks, using the first')
+    return list(sites.values())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the transit catalogue for the sites in a settings file')
+    parser.add_argument('settings', help='Settings file to take the data location, networks and catalogue from')
+    parser.add_argument('-db', default='database_60_10_nov.json', help='Target database in /starting_data/')
+    parser.add_argument('-st', default='2020-01-01', help='Start date, format "YYYY-mm-dd"')
+    parser.add_argument('-ed', default='2031-01-01', help='End date, format "YYYY-mm-dd"')
+    args = parser.parse_args()
+    setting_data = settings.Settings(args.settings)
+    if setting_data.catalog_file is None:
+        print('Set TRANSIT_CATALOG in the settings file to the location to write the catalogue')
+        raise Exception
+
+    targets = tools.load_json(f'{setting_data.data_root}/starting_data/{args.db}')
+    telescopes = catalog_sites(setting_data.data_root, setting_data.telescopes)
+    start = datetime.strptime(args.st, '%Y-%m-%d')
+    end = datetime.strptime(args.ed, '%Y-%m-%d')
+    transit_catalog = TransitCatalog().build(targets, telescopes, start, end)
+    transit_catalog.save(setting_data.catalog_file)
+    print(f'{len(transit_catalog.rows)} transits of {len(targets)} targets at {len(telescopes)} sites written to '
+          f'{setting_data.catalog_file}')
+
+
+if __name__ == '__main__':
+    main()
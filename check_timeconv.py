@@ -0,0 +1,146 @@
+#################################################################
+# Checks the conversions in timeconv against those they replaced,
+# julian 0.14, PyAstronomy's jdcnv and the GMST functions that
+# were in mini_staralt, over random times in 2019-2031. julian is
+# no longer a dependency, so its to_jd and from_jd are copied here.
+# Usage: python check_timeconv.py [-n 10000] [-seed 1]
+#################################################################
+import argparse
+import math
+from datetime import datetime, timedelta
+
+import numpy as np
+from PyAstronomy import pyasl
+
+import timeconv
+
+
+def julian_to_jd(dt):
+    """
+    julian.to_jd(dt, fmt='jd') from julian 0.14
+    :param dt: datetime
+    :return: Julian date: float
+    """
+    a = math.floor((14-dt.month)/12)
+    y = dt.year + 4800 - a
+    m = dt.month + 12*a - 3
+    jdn = dt.day + math.floor((153*m + 2)/5) + 365*y + math.floor(y/4) - math.floor(y/100) + math.floor(y/400) - 32045
+    return jdn + (dt.hour - 12) / 24 + dt.minute / 1440 + dt.second / 86400 + dt.microsecond / 86400000000
+
+
+def julian_from_jd(jd):
+    """
+    julian.from_jd(jd, fmt='jd') from julian 0.14
+    :param jd: Julian date: float
+    :return: datetime
+    """
+    jd, jdf = math.floor(jd + 0.5), jd + 0.5 - math.floor(jd + 0.5)
+    l = jd+68569
+    n = 4*l//146097
+    l = l-(146097*n+3)//4
+    i = 4000*(l+1)//1461001
+    l = l-1461*i//4+31
+    j = 80*l//2447
+    k = l-2447*j//80
+    l = j//11
+    j = j+2-12*l
+    i = 100*(n-49)+i+l
+
+    frac_component = int(jdf * (1e6*24*3600))  # in microseconds
+    hours = int(frac_component // (1e6*3600))
+    frac_component -= hours * 1e6*3600
+    minutes = int(frac_component // (1e6*60))
+    frac_component -= minutes * 1e6*60
+    seconds = int(frac_component // 1e6)
+    frac_component -= seconds*1e6
+    return datetime(year=int(i), month=int(j), day=int(k), hour=hours, minute=minutes, second=seconds,
+                    microsecond=int(frac_component))
+
+
+def staralt_gmst(j_date):
+    """
+    mini_staralt.get_gmst before timeconv
+    :param j_date: Julian date: float
+    :return: GMST in decimal hours
+    """
+    du = j_date - 2451545
+    du_mod = math.fmod(du, 1)
+    T = (j_date - 2451545) / 36525
+    gmst_sec = 86400 * (
+                0.7790572732640 + 0.00273781191135448 * du + du_mod) + 0.00096707 + 307.47710227 * T + 0.092772113 * (
+                           T ** 2) - 0.0000000293 * (T ** 3) + 0.00000199707 * (T ** 4) - 0.000000002453 * (T ** 5)
+    return math.fmod(gmst_sec / 3600, 24)
+
+
+def staralt_gmst_utc_diff(date):
+    """
+    mini_staralt.get_gmst_utc_diff before timeconv
+    :param date: datetime
+    :return: GMST - UTC in decimal hours, between 0 and 24
+    """
+    gmst_dec = staralt_gmst(pyasl.jdcnv(date))
+    date_dec = date.hour + date.minute / 60 + date.second / 3600
+    gmst_utc_diff = gmst_dec - date_dec
+    if gmst_utc_diff < 0:
+        gmst_utc_diff += 24
+    return gmst_utc_diff
+
+
+def check(n, seed):
+    """
+    Compares timeconv with the old conversions at n random times, and its array forms with its scalar ones
+    :param n: Number of times
+    :param seed: Seed for the random number generator
+    :return: Whether every difference is within its tolerance: boolean
+    """
+    rng = np.random.default_rng(seed)
+    start = datetime(year=2019, month=1, day=1)
+    microseconds = rng.integers(0, 12 * 365 * 86400 * 10**6, n)
+    dates = [start + timedelta(microseconds=int(offset)) for offset in microseconds]
+    jd = np.array([julian_to_jd(date) for date in dates])
+    mjd = jd - timeconv.MJD_OFFSET
+
+    def seconds(a, b):
+        return max(abs((x - y).total_seconds()) for x, y in zip(a, b))
+
+    # largest difference, and tolerance, of each check: seconds for times, hours for sidereal times
+    differences = {
+        'to_jd, julian.to_jd': (np.max(np.abs([timeconv.to_jd(date) for date in dates] - jd)) * 86400, 1e-4),
+        'to_jd, pyasl.jdcnv': (np.max(np.abs([timeconv.to_jd(date) - pyasl.jdcnv(date) for date in dates])) * 86400,
+                               1e-4),
+        'to_jd, array': (np.max(np.abs(timeconv.to_jd(dates) - jd)) * 86400, 1e-4),
+        'to_mjd, julian.to_jd - 2400000': (np.max(np.abs(timeconv.to_mjd(dates) - mjd)) * 86400, 1e-4),
+        'from_mjd, julian.from_jd': (seconds([timeconv.from_mjd(value) for value in mjd.tolist()],
+                                             [julian_from_jd(value) for value in jd.tolist()]), 1e-4),
+        'from_mjd, array': (seconds(timeconv.from_mjd(mjd).astype(datetime),
+                                    [timeconv.from_mjd(value) for value in mjd.tolist()]), 1e-4),
+        'from_mjd, to_mjd round trip': (seconds([timeconv.from_mjd(timeconv.to_mjd(date)) for date in dates], dates),
+                                        1e-4),
+        'gmst, mini_staralt.get_gmst': (np.max(np.abs(timeconv.gmst(jd) - [staralt_gmst(value) for value in jd])),
+                                        1e-9),
+        # the old function left the fraction of a second out of the UTC, so differs by up to a second
+        'gmst_utc_diff, mini_staralt.get_gmst_utc_diff': (
+            np.max(np.abs([float(timeconv.gmst_utc_diff(timeconv.to_jd(date))) - staralt_gmst_utc_diff(date)
+                           for date in dates])), 1.1 / 3600),
+    }
+
+    same = True
+    print('#Check, LargestDifference, Tolerance, Within')
+    for name, (difference, tolerance) in differences.items():
+        within = difference <= tolerance
+        same = same and within
+        print(f'{name}, {difference:.3g}, {tolerance:g}, {"Y" if within else "N"}')
+    return same
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check timeconv against the conversions it replaced')
+    parser.add_argument('-n', type=int, default=10000, help='Number of random times to check')
+    parser.add_argument('-seed', type=int, default=1, help='Seed for the random number generator')
+    args = parser.parse_args()
+    if not check(args.n, args.seed):
+        raise Exception
+
+
+if __name__ == '__main__':
+    main()
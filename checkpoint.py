@@ -0,0 +1,87 @@
+#################################################################
+# Checkpoints of a simulation run, so a run stopped part way,
+# by a crash or a pre-empted job, can carry on from where it
+# was rather than starting again. The state is pickled, which
+# keeps the Targets shared between the state's containers,
+# and each checkpoint replaces the last atomically.
+#################################################################
+import pickle
+import time
+from os import fsync, path, remove, replace
+
+CHECKPOINT_VERSION = 1
+
+
+class Checkpoint:
+    """
+    Writes the state of a run every so many blocks, or every so many seconds, whichever comes first
+    """
+    def __init__(self):
+        """
+        Null constructor
+        """
+        self.filename = None
+        self.every_blocks = 0
+        self.every_seconds = 0.
+        self.blocks = 0
+        self.last_saved = None
+
+    def init_checkpoint(self, filename, every_blocks=0, every_seconds=0.):
+        """
+        :param filename: Location of the checkpoint file
+        :param every_blocks: Blocks between checkpoints, 0 for none: int
+        :param every_seconds: Seconds between checkpoints, 0 for none: float
+        :return: Filled Checkpoint object
+        """
+        self.filename = filename
+        self.every_blocks = every_blocks
+        self.every_seconds = every_seconds
+        self.last_saved = time.monotonic()
+        return self
+
+    def enabled(self):
+        return self.every_blocks > 0 or self.every_seconds > 0
+
+    def exists(self):
+        return self.filename is not None and path.exists(self.filename)
+
+    def due(self):
+        """
+        Counts a finished block, and checks whether a checkpoint should be written
+        :return: Result of the check: boolean
+        """
+        self.blocks += 1
+        return (0 < self.every_blocks <= self.blocks or
+                0 < self.every_seconds <= time.monotonic() - self.last_saved)
+
+    def save(self, state):
+        """
+        Writes the state, replacing the last checkpoint atomically, so there is always a complete one to resume from
+        :param state: State of the run: dict
+        """
+        tmp_name = self.filename + '.tmp'
+        with open(tmp_name, 'wb') as f:
+            pickle.dump({'version': CHECKPOINT_VERSION, 'state': state}, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            fsync(f.fileno())  # on disk before it replaces the last one
+        replace(tmp_name, self.filename)
+        self.blocks = 0
+        self.last_saved = time.monotonic()
+
+    def load(self):
+        """
+        :return: State of the run from the last checkpoint: dict
+        """
+        with open(self.filename, 'rb') as f:
+            data = pickle.load(f)
+        if data['version'] != CHECKPOINT_VERSION:
+            print(f'Checkpoint {self.filename} was written by a different version, start the run again')
+            raise Exception
+        return data['state']
+
+    def clear(self):
+        """
+        Removes the checkpoint once the run has finished
+        """
+        if self.exists():
+            remove(self.filename)
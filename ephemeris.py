@@ -0,0 +1,293 @@
+import mini_staralt
+import timeconv
+import numpy as np
+from PyAstronomy import pyasl
+from datetime import timedelta
+from os import path, replace
+
+
+class NightEphemeris:
+    """
+    Table of sunset and sunrise times for each site and night of a run, computed once with the batched mini_staralt
+    functions and shared by the visibility checks and the night time counters. Times are held as float MJD
+    """
+    def __init__(self):
+        """
+        Null constructor
+        """
+        self.sites = []
+        self.lats = None
+        self.lons = None
+        self.start = None
+        self.start_mjd = None
+        self.n_nights = 0
+        self.sundowns = []
+        self.sunset = {}
+        self.sunrise = {}
+
+    def build(self, telescopes, start, end, sundowns=(-20, -12)):
+        """
+        Fills the table for every telescope and every night between the dates given, with a day of margin either side
+        :param telescopes: List of Telescope objects in the network
+        :param start: Start of the run: datetime
+        :param end: End of the run: datetime
+        :param sundowns: Sun altitudes to tabulate, in degrees: list of floats
+        :return: Filled NightEphemeris object
+        """
+        self.sites = [telescope.name for telescope in telescopes]
+        self.lats = np.array([telescope.lat for telescope in telescopes])
+        self.lons = np.array([telescope.lon for telescope in telescopes])
+        self.start = start.replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=1)
+        self.start_mjd = timeconv.to_mjd(self.start)
+        self.n_nights = (end.replace(hour=0, minute=0, second=0, microsecond=0) - self.start).days + 2
+        self.sundowns = [float(sundown) for sundown in sundowns]
+
+        dates = np.datetime64(self.start, 'us') + np.arange(self.n_nights) * np.timedelta64(1, 'D')
+        for sundown in self.sundowns:
+            # one row per site, one column per night
+            sunset, sunrise, _, _ = mini_staralt.sun_set_rise_array(
+                dates[np.newaxis, :], self.lons[:, np.newaxis], self.lats[:, np.newaxis], sundown)
+            self.sunset[sundown] = timeconv.to_mjd(sunset)  # NaT becomes NaN
+            self.sunrise[sundown] = timeconv.to_mjd(sunrise)
+
+        return self
+
+    def covers(self, telescopes, start, end, sundowns=(-20, -12)):
+        """
+        Checks whether the table already holds the sites, dates and sun altitudes requested
+        :return: Result of the check: boolean
+        """
+        if self.start is None:
+            return False
+        for telescope in telescopes:
+            if telescope.name not in self.sites:
+                return False
+            i = self.sites.index(telescope.name)
+            if self.lats[i] != telescope.lat or self.lons[i] != telescope.lon:
+                return False
+        for sundown in sundowns:
+            if float(sundown) not in self.sundowns:
+                return False
+        first = start.replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=1)
+        last = end.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+        return self.start <= first and last <= self.start + timedelta(days=self.n_nights - 1)
+
+    def sun_set_rise(self, date, telescope, sundown):
+        """
+        Looks up sunset and sunrise for the night starting on the date given, falling back to a direct calculation for
+        nights, sites or sun altitudes not in the table
+        :param date: Midnight at the start of the day: float MJD
+        :param telescope: Telescope object for the site
+        :param sundown: Sun altitude defining night in degrees: float
+        :return: Sunset and sunrise: float MJDs, or None if the sun does not cross the altitude
+        """
+        night = int(round(date - self.start_mjd)) if self.start_mjd is not None else -1
+        if (0 <= night < self.n_nights and float(sundown) in self.sundowns and telescope.name in self.sites
+                and abs(date - self.start_mjd - night) < 1e-6):
+            site = self.sites.index(telescope.name)
+            sunset = self.sunset[float(sundown)][site, night]
+            sunrise = self.sunrise[float(sundown)][site, night]
+            if np.isnan(sunset) or np.isnan(sunrise):
+                return None
+            return float(sunset), float(sunrise)
+        return direct_sun_set_rise(date, telescope, sundown)
+
+    def save(self, filename):
+        """
+        Writes the table to a .npz file, replacing any existing file atomically
+        :param filename: Location of the file to write
+        """
+        arrays = {'sites': np.array(self.sites), 'lats': self.lats, 'lons': self.lons,
+                  'start': self.start_mjd, 'n_nights': self.n_nights,
+                  'sundowns': np.array(self.sundowns)}
+        for i, sundown in enumerate(self.sundowns):
+            arrays[f'sunset_{i}'] = self.sunset[sundown]
+            arrays[f'sunrise_{i}'] = self.sunrise[sundown]
+        tmp_name = filename + '.tmp.npz'
+        np.savez(tmp_name, **arrays)
+        replace(tmp_name, filename)
+
+    def load(self, filename):
+        """
+        Fills the table from a file written by save
+        :param filename: Location of the file to read
+        :return: Filled NightEphemeris object
+        """
+        with np.load(filename) as data:
+            self.sites = [str(site) for site in data['sites']]
+            self.lats = data['lats']
+            self.lons = data['lons']
+            self.start_mjd = float(data['start'])
+            self.start = timeconv.from_mjd(self.start_mjd)
+            self.n_nights = int(data['n_nights'])
+            self.sundowns = [float(sundown) for sundown in data['sundowns']]
+            for i, sundown in enumerate(self.sundowns):
+                self.sunset[sundown] = data[f'sunset_{i}']
+                self.sunrise[sundown] = data[f'sunrise_{i}']
+        return self
+
+
+def load_or_build_nights(filename, telescopes, start, end):
+    """
+    Loads the night table from disk if it covers the run, otherwise builds it and, if a filename is given, saves it
+    :param filename: Location of the cached table, or None to skip caching
+    :param telescopes: List of Telescope objects in the network
+    :param start: Start of the run: datetime
+    :param end: End of the run: datetime
+    :return: NightEphemeris object
+    """
+    if filename is not None and path.exists(filename):
+        nights = NightEphemeris().load(filename)
+        if nights.covers(telescopes, start, end):
+            return nights
+    nights = NightEphemeris().build(telescopes, start, end)
+    if filename is not None:
+        nights.save(filename)
+    return nights
+
+
+def direct_sun_set_rise(date, telescope, sundown):
+    """
+    Sunset and sunrise for a site from mini_staralt, converted to MJD
+    :param date: Midnight at the start of the day: float MJD
+    :param telescope: Telescope object for the site
+    :param sundown: Sun altitude defining night in degrees: float
+    :return: Sunset and sunrise: float MJDs, or None if the sun does not cross the altitude
+    """
+    sun_times = mini_staralt.sun_set_rise(timeconv.from_mjd(date), lon=telescope.lon, lat=telescope.lat,
+                                          sundown=sundown)
+    if sun_times is None:
+        return None
+    return timeconv.to_mjd(sun_times[0]), timeconv.to_mjd(sun_times[1])
+
+
+def sun_set_rise(nights, date, telescope, sundown):
+    """
+    Sunset and sunrise for a site from the night table if one is available, else from mini_staralt directly
+    :param nights: NightEphemeris object or None
+    :param date: Midnight at the start of the day: float MJD
+    :param telescope: Telescope object for the site
+    :param sundown: Sun altitude defining night in degrees: float
+    :return: Sunset and sunrise: float MJDs
+    """
+    if nights is not None:
+        return nights.sun_set_rise(date, telescope, sundown)
+    return direct_sun_set_rise(date, telescope, sundown)
+
+
+class MoonEphemeris:
+    """
+    Grid of the moon's phase and position over a run, computed once with PyAstronomy and interpolated for each
+    transit. These do not depend on the site, so only the altitude is calculated per telescope
+    """
+    def __init__(self):
+        """
+        Null constructor
+        """
+        self.jd = None
+        self.phase = None
+        self.ra = None
+        self.dec = None
+
+    def build(self, start, end, step=timedelta(hours=1)):
+        """
+        Fills the grid between the dates given, with a day of margin either side
+        :param start: Start of the run: datetime
+        :param end: End of the run: datetime
+        :param step: Spacing of the grid: timedelta
+        :return: Filled MoonEphemeris object
+        """
+        first = timeconv.to_jd(start - timedelta(days=1))
+        last = timeconv.to_jd(end + timedelta(days=1))
+        self.jd = np.arange(first, last + step / timedelta(days=1), step / timedelta(days=1))
+        self.phase = pyasl.moonphase(self.jd)
+        position = pyasl.moonpos(self.jd)
+        self.ra = np.degrees(np.unwrap(np.radians(position[0])))  # unwrapped so it can be interpolated across 0/360
+        self.dec = position[1]
+        return self
+
+    def covers(self, jd):
+        """
+        Checks whether the julian dates given are inside the grid
+        :param jd: Julian date(s) to check
+        :return: Result of the check: boolean
+        """
+        return self.jd is not None and self.jd[0] <= np.min(jd) and np.max(jd) <= self.jd[-1]
+
+    def get_phase(self, jd):
+        """
+        Interpolates the moon phase
+        :param jd: Julian date(s)
+        :return: Illuminated fraction of the moon
+        """
+        return np.interp(jd, self.jd, self.phase)
+
+    def get_position(self, jd):
+        """
+        Interpolates the moon's position
+        :param jd: Julian date(s)
+        :return: Right ascension and declination in degrees
+        """
+        return np.mod(np.interp(jd, self.jd, self.ra), 360), np.interp(jd, self.jd, self.dec)
+
+
+# reference for day of year numbering in the seasonal visibility index, MJD of 2000-01-01T00:00
+DAY_OF_YEAR_ZERO = 51544.5
+
+
+def day_of_year(mjd):
+    """
+    Day of the year a time falls on, counted in 365.25 day years so it can be used as an index for any year
+    :param mjd: Time(s): float MJD or array
+    :return: Day of year, 0 to 365
+    """
+    return np.floor(np.mod(np.floor(np.asarray(mjd) - 0.5) + 0.5 - DAY_OF_YEAR_ZERO, 365.25)).astype(int)
+
+
+def build_visibility_index(targets, telescopes, start, mintargetalt=30, sundown=-20, margin=1):
+    """
+    Records for each target and site which days of the year a transit center can fall while the target is above
+    mintargetalt and the sun below sundown, as a boolean array of 366 days in target.observable_days. A target that
+    never rises high enough at the site gets an array that is all False. Used by Target.transit_forecast to skip
+    epochs without calculating their visibility, so the windows are widened by a margin of days either side to cover
+    the changes in sunset and sunrise from year to year
+    :param targets: List of Target objects
+    :param telescopes: List of Telescope objects in the network
+    :param start: Start of the run, two years of nights from here are used: datetime
+    :param mintargetalt: Minimum target altitude in degrees: float
+    :param sundown: Sun altitude defining night in degrees: float
+    :param margin: Days to widen each observable window by: int
+    """
+    start_mjd = timeconv.to_mjd(start.replace(hour=0, minute=0, second=0, microsecond=0))
+    dates = start_mjd + np.arange(-1, 2 * 366)
+    doy = day_of_year(dates[1:])
+    slack = 0.05  # hours of slack on each window
+
+    rise_lst = np.empty((len(targets), 1))
+    up_hours = np.empty((len(targets), 1))
+    for telescope in telescopes:
+        sunset, sunrise, _, _ = mini_staralt.sun_set_rise_array(timeconv.from_mjd(dates), telescope.lon,
+                                                                telescope.lat, sundown)
+        sunset, sunrise = timeconv.to_mjd(sunset), timeconv.to_mjd(sunrise)
+        night_lst = timeconv.lst(sunset + timeconv.MJD_OFFSET, telescope.lon)[np.newaxis, :] - slack
+        night_hours = (sunrise - sunset)[np.newaxis, :] * 24 * mini_staralt.SIDEREAL_RATE + 2 * slack
+
+        for i, single in enumerate(targets):
+            single.obtain_rise_set_lst([telescope], mintargetalt)
+            rise_lst[i], up_hours[i] = single.rise_set_lst[telescope.name]
+        target_lst = rise_lst - slack
+        target_hours = np.where(up_hours > 0, up_hours + 2 * slack, 0)
+
+        # circular overlap of the target's time above the altitude with each night, in sidereal time
+        overlap = (np.mod(night_lst - target_lst, 24) < target_hours) | (
+                np.mod(target_lst - night_lst, 24) < night_hours) | (target_hours >= 24) | (night_hours >= 24)
+        overlap |= np.isnan(night_hours) & (target_hours > 0)  # sun never sets or rises, keep to be safe
+
+        # a transit center on a date falls in that date's night or the previous one
+        on_date = overlap[:, 1:] | overlap[:, :-1]
+        for i, single in enumerate(targets):
+            days = np.zeros(366, dtype=bool)
+            days[doy[on_date[i]]] = True
+            for shift in range(1, margin + 1):
+                days |= np.roll(days, shift) | np.roll(days, -shift)
+            single.observable_days[telescope.name] = days
@@ -0,0 +1,244 @@
+#################################################################
+# Queue of sweep jobs in a directory shared between machines,
+# needing no broker. Jobs are files moved between pending/,
+# claimed/ and done/ with renames, which are atomic, so only
+# one worker can claim each job. Workers touch their claimed
+# files as a heartbeat, and jobs whose heartbeat stops, from a
+# worker that died, are moved back to pending/ for another.
+# Jobs that raise an error, or stop too many workers, are moved
+# to failed/ with the reason, so they are not run again.
+#################################################################
+import json
+import socket
+import threading
+import time
+import traceback
+from os import getpid, listdir, makedirs, path, remove, rename, replace, utime
+
+
+class Heartbeat(threading.Thread):
+    """
+    Background thread touching a claimed job file while the job runs, noting if the claim is lost because the job was
+    taken back by another worker
+    """
+    def __init__(self, filename, interval):
+        """
+        :param filename: Location of the claimed job file
+        :param interval: Time between heartbeats in seconds: float
+        """
+        super().__init__(daemon=True)
+        self.filename = filename
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.lost = False
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                utime(self.filename)
+            except FileNotFoundError:
+                self.lost = True
+                return
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+class JobQueue:
+    """
+    Jobs of a sweep held as .json files in a shared directory. A job's file name starts with its place in the queue,
+    and a claimed job's file has the worker's name added after an @
+    """
+    def __init__(self, directory, timeout=600., heartbeat=60., attempts=3):
+        """
+        :param directory: Location of the queue, on a filesystem shared by all the workers
+        :param timeout: Seconds without a heartbeat before a claimed job is taken back: float
+        :param heartbeat: Seconds between heartbeats: float
+        :param attempts: Number of workers a job can stop, by their heartbeats stopping, before it is failed: int
+        """
+        self.directory = path.abspath(directory)
+        self.timeout = timeout
+        self.heartbeat = heartbeat
+        self.attempts = attempts
+        self.worker = f'{socket.gethostname()}-{getpid()}'.replace('@', '-').replace('/', '-')
+        self.pending = path.join(self.directory, 'pending')
+        self.claimed = path.join(self.directory, 'claimed')
+        self.done = path.join(self.directory, 'done')
+        self.failed = path.join(self.directory, 'failed')
+
+    def __str__(self):
+        pending, claimed, done = self.counts()
+        failed = len(listdir(self.failed)) // 2 if path.exists(self.failed) else 0  # each with its reason
+        return f'Job queue {self.directory}: {pending} pending, {claimed} running, {done} done, {failed} failed'
+
+    def create(self, records, info):
+        """
+        Makes a new queue holding the jobs given, in the order given
+        :param records: Dictionary of each job's parameters, with its name under 'id': list of dicts
+        :param info: Details of the sweep shared by the jobs: dict
+        """
+        if path.exists(path.join(self.directory, 'queue.json')):
+            print(f'A job queue already exists at {self.directory}')
+            raise Exception
+        for directory in (self.pending, self.claimed, self.done, self.failed):
+            makedirs(directory, exist_ok=True)
+        for place, record in enumerate(records):
+            write_json(path.join(self.pending, f'{place:05d}_{record["id"]}.json'), record)
+        write_json(path.join(self.directory, 'queue.json'), info)  # written last, the queue is ready once it is there
+
+    def info(self):
+        """
+        :return: Details of the sweep given when the queue was made: dict
+        """
+        with open(path.join(self.directory, 'queue.json')) as f:
+            return json.load(f)
+
+    def counts(self):
+        """
+        :return: Number of pending, claimed and done jobs
+        """
+        return len(listdir(self.pending)), len(listdir(self.claimed)), len(listdir(self.done))
+
+    def claim(self):
+        """
+        Claims the first pending job, by moving it to claimed/ under this worker's name. If another worker moves it
+        first the next one is tried
+        :return: File name of the job and its parameters, or None if there are no pending jobs
+        """
+        for name in sorted(listdir(self.pending)):
+            claimed = path.join(self.claimed, f'{name}@{self.worker}')
+            try:
+                rename(path.join(self.pending, name), claimed)
+            except FileNotFoundError:
+                continue  # claimed by another worker
+            utime(claimed)  # a rename keeps the old time, start the heartbeat from now
+            with open(claimed) as f:
+                return name, json.load(f)
+        return None
+
+    def finish(self, name):
+        """
+        Moves a job claimed by this worker to done/
+        :param name: File name of the job
+        :return: Whether the job was still claimed by this worker: boolean
+        """
+        try:
+            rename(path.join(self.claimed, f'{name}@{self.worker}'), path.join(self.done, name))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def fail(self, name, reason, worker=None):
+        """
+        Moves a claimed job to failed/, with the reason it failed in a .txt file beside it
+        :param name: File name of the job
+        :param reason: Why the job failed, such as the traceback of its error: str
+        :param worker: Name of the worker holding the claim, this worker if not given
+        :return: Whether the job was still claimed by the worker: boolean
+        """
+        makedirs(self.failed, exist_ok=True)
+        try:
+            rename(path.join(self.claimed, f'{name}@{worker or self.worker}'), path.join(self.failed, name))
+        except FileNotFoundError:
+            return False
+        with open(path.join(self.failed, name[:-len('.json')] + '.txt'), 'w') as f:
+            f.write(reason)
+        return True
+
+    def now(self):
+        """
+        Current time on the shared filesystem, so heartbeats from machines with different clocks can be compared
+        :return: Time in seconds
+        """
+        probe = path.join(self.directory, f'clock@{self.worker}')
+        with open(probe, 'w'):
+            pass
+        now = path.getmtime(probe)
+        remove(probe)
+        return now
+
+    def reclaim(self):
+        """
+        Moves jobs whose worker has not sent a heartbeat within the timeout back to pending/, counting the attempt in
+        the job, or to failed/ once it has stopped as many workers as allowed
+        :return: Number of jobs moved back
+        """
+        now = self.now()
+        reclaimed = 0
+        for claimed in listdir(self.claimed):
+            name = claimed.split('@')[0]
+            taken = path.join(self.claimed, f'{name}@reclaim-{self.worker}')
+            try:
+                if now - path.getmtime(path.join(self.claimed, claimed)) < self.timeout:
+                    continue
+                rename(path.join(self.claimed, claimed), taken)  # only one worker takes it back
+            except FileNotFoundError:
+                continue  # finished, or taken back by another worker
+            with open(taken) as f:
+                record = json.load(f)
+            record['attempts'] = record.get('attempts', 0) + 1
+            write_json(taken, record)
+            if record['attempts'] >= self.attempts:
+                self.fail(name, f'Stopped sending heartbeats on {record["attempts"]} workers\n',
+                          f'reclaim-{self.worker}')
+                print(f'Job {claimed} stopped sending heartbeats, failed after {record["attempts"]} attempts')
+                continue
+            rename(taken, path.join(self.pending, name))
+            print(f'Job {claimed} stopped sending heartbeats, returned to the queue')
+            reclaimed += 1
+        return reclaimed
+
+    def finished(self):
+        """
+        :return: Parameters of the jobs that are done, in queue order: list of dicts
+        """
+        records = []
+        for name in sorted(listdir(self.done)):
+            with open(path.join(self.done, name)) as f:
+                records.append(json.load(f))
+        return records
+
+    def work(self, run, poll=10.):
+        """
+        Runs jobs from the queue until there are none left, including any that are taken back from dead workers while
+        others are still running. A job whose run raises an error is moved to failed/ with its traceback
+        :param run: Function running a job from its parameters
+        :param poll: Seconds to wait between checks while other workers' jobs are running: float
+        :return: Number of jobs this worker finished
+        """
+        finished = 0
+        while True:
+            self.reclaim()
+            job = self.claim()
+            if job is None:
+                if len(listdir(self.claimed)) == 0:
+                    return finished
+                time.sleep(poll)
+                continue
+            name, record = job
+            heartbeat = Heartbeat(path.join(self.claimed, f'{name}@{self.worker}'), self.heartbeat)
+            heartbeat.start()
+            try:
+                run(record)
+            except Exception:
+                heartbeat.stop()
+                print(f'Job {name} failed:\n{traceback.format_exc()}')
+                self.fail(name, traceback.format_exc())
+                continue
+            heartbeat.stop()
+            if self.finish(name) and not heartbeat.lost:
+                finished += 1
+            else:
+                print(f'Job {name} was taken back from this worker before it finished')
+
+
+def write_json(filename, values):
+    """
+    Writes a .json file, replacing any existing file atomically
+    :param filename: Location of the file
+    :param values: Values to write
+    """
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(values, f)
+    replace(filename + '.tmp', filename)
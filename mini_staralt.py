@@ -3,6 +3,8 @@ from PyAstronomy import pyasl
 import datetime
 import numpy as np
 
+import timeconv
+
 
 class Error(Exception):
     pass
@@ -20,14 +22,7 @@ def get_gmst(j_date):
     # input: julian date
     # return GMST for a given julian date
 
-    du = j_date - 2451545
-    du_mod = math.fmod(du, 1)
-    T = (j_date - 2451545) / 36525
-    gmst_sec = 86400 * (
-                0.7790572732640 + 0.00273781191135448 * du + du_mod) + 0.00096707 + 307.47710227 * T + 0.092772113 * (
-                           T ** 2) - 0.0000000293 * (T ** 3) + 0.00000199707 * (T ** 4) - 0.000000002453 * (T ** 5)
-    gmst_deg = math.fmod(gmst_sec / 3600, 24)
-    return gmst_deg
+    return float(timeconv.gmst(j_date))
 
 
 def get_gmst_utc_diff(date):
@@ -36,13 +31,7 @@ def get_gmst_utc_diff(date):
     # get gmst/utc difference for a given date
     # you can then get lst by subtracting EAST longitude
 
-    jd = pyasl.jdcnv(date)  # find Julian date for given date in UTC
-    gmst_dec = get_gmst(jd)  # get gmst in decimal format
-    date_dec = date.hour + date.minute / 60 + date.second / 3600 # get UTC for date in decimal format
-    gmst_utc_diff = gmst_dec - date_dec # get gmst - utc difference
-    if gmst_utc_diff < 0:
-        gmst_utc_diff += 24
-    return gmst_utc_diff
+    return float(timeconv.gmst_utc_diff(timeconv.to_jd(date)))
 
 
 def get_set_rise(start_date, ra, dec, lon, lat, h=0, skip_negative_check=False):
@@ -199,9 +188,8 @@ def get_rise_set(start_date, ra, dec, lon, lat, h=0, skip_negative_check=False):
 
 
 def sun_set_rise(start_date, lon, lat, sundown):
-    from PyAstronomy import pyasl
 
-    jd_set = pyasl.jdcnv(start_date)  # find Julian date
+    jd_set = timeconv.to_jd(start_date)  # find Julian date
     sunpos = pyasl.sunpos(jd_set)
     sun_ra, sun_dec = sunpos[1][0], sunpos[2][0]
 
@@ -231,30 +219,27 @@ def target_rise_set(date, ra, dec, lon, lat, mintargetalt):
 
 def get_moon_phase(date):
 
-    jd = pyasl.jdcnv(date)
+    jd = timeconv.to_jd(date)
     phase = pyasl.moonphase(jd)
     return phase[0]
 
 
 def get_moon_alt(date, telescope):
-    from math import asin, sin, cos, radians, degrees
-    jd = pyasl.jdcnv(date)
+    jd = timeconv.to_jd(date)
     pos_celestial = pyasl.moonpos(jd)
     ra, dec = pos_celestial[0][0], pos_celestial[1][0]
-    lst = get_lst(jd, telescope.lon) * 15
-    #print('LST:', lst)
+    return float(get_alt(jd, ra, dec, telescope.lon, telescope.lat))
+
+
+def get_alt(jd, ra, dec, lon, lat):
 
-    HA = lst - ra
-    if HA < 0:
-        HA += 360
-    elif HA > 360:
-        HA -= 360
-    #print('HA:', HA)
+    # input: julian date(s), ra and dec of the object in degrees, site lon and lat in degrees
+    # return altitude of the object in degrees
 
-    asin_alt = sin(radians(dec))*sin(radians(telescope.lat)) + cos(radians(dec))*cos(radians(telescope.lat))*cos(radians(HA))
-    alt = degrees(asin(asin_alt))
-    #print('alt:', alt)
-    return alt
+    HA = np.radians(timeconv.gmst(jd) * 15 + lon - ra)
+    asin_alt = np.sin(np.radians(dec)) * np.sin(np.radians(lat)) + np.cos(np.radians(dec)) * np.cos(
+        np.radians(lat)) * np.cos(HA)
+    return np.degrees(np.arcsin(asin_alt))
 
 
 
@@ -284,6 +269,191 @@ def get_moon_alt(date, telescope):
 #     print('target pos:', vars(aa))
 
 def get_lst(jd, longitude):
-    gmst = get_gmst(jd)
-    lst = (gmst + longitude / 15) % 24
-    return lst
+    return float(timeconv.lst(jd, longitude))
+
+
+# Batched versions of the rise/set calculations above. These take arrays of dates, site coordinates and target
+# coordinates (broadcast against each other) and evaluate every element in one pass. Instead of raising
+# NeverVisibleError/AlwaysVisibleError they return boolean masks, with NaN/NaT in the masked elements.
+
+def _get_crossings_array(start_jd, ra, dec, lon, lat, h, set_first, skip_negative_check=False):
+
+    # shared core of get_rise_set_array and get_set_rise_array
+    # returns the first and second crossing of altitude h in hours after start_jd, plus never/always masks
+    # set_first=False gives rise then set (as get_rise_set), set_first=True gives set then rise (as get_set_rise)
+
+    start_jd, ra, dec, lon, lat = [np.array(x, dtype=float) for x in
+                                   np.broadcast_arrays(start_jd, ra, dec, lon, lat)]
+
+    factor = (np.sin(np.radians(h)) - np.sin(np.radians(dec)) * np.sin(np.radians(lat))) / (
+            np.cos(np.radians(dec)) * np.cos(np.radians(lat)))
+    never = factor > 1
+    always = factor < -1
+    valid = ~never & ~always
+
+    HA = np.degrees(np.arccos(np.clip(factor, -1, 1)))
+    if set_first:
+        first = ra + HA / 15.
+        second = ra - HA / 15. + 24  # shift rise by 24h, so we have set first, then rise
+    else:
+        first = ra - HA / 15.
+        second = ra + HA / 15.
+    shift = np.where(first < 0, 24, 0)
+    first += shift
+    second += shift
+
+    # refine lst adjustment at each crossing, element-wise until each is accurate to within the tolerance
+    gmst_utc_diff_first = timeconv.gmst_utc_diff(start_jd)
+    gmst_utc_diff_second = gmst_utc_diff_first.copy()
+    first_lst_adj = np.zeros_like(first)
+    second_lst_adj = np.zeros_like(second)
+    active = valid.copy()
+    while active.any():
+        first_tmp = first - gmst_utc_diff_first - lon / 15
+        second_tmp = second - gmst_utc_diff_second - lon / 15
+        shift = np.where(first_tmp < 0, 24, 0)
+        first_tmp += shift
+        second_tmp += shift
+        new_diff_first = timeconv.gmst_utc_diff(start_jd + first_tmp / 24)
+        new_diff_second = timeconv.gmst_utc_diff(start_jd + second_tmp / 24)
+        new_first_adj = first - new_diff_first
+        new_second_adj = second - new_diff_second
+        shift = np.where(new_first_adj < 0, 24, 0)
+        new_first_adj += shift
+        new_second_adj += shift
+        diff = np.abs(first_lst_adj - new_first_adj) + np.abs(second_lst_adj - new_second_adj)
+
+        gmst_utc_diff_first = np.where(active, new_diff_first, gmst_utc_diff_first)
+        gmst_utc_diff_second = np.where(active, new_diff_second, gmst_utc_diff_second)
+        first_lst_adj = np.where(active, new_first_adj, first_lst_adj)
+        second_lst_adj = np.where(active, new_second_adj, second_lst_adj)
+        active &= diff > 1
+
+    # adjust for longitude
+    first_final = first_lst_adj - lon / 15
+    second_final = second_lst_adj - lon / 15
+
+    if not skip_negative_check:
+        # first crossing is the previous day, use the next day's crossings instead, then add 24h
+        negative = valid & (first_final < 0)
+        if negative.any():
+            first_next, second_next, _, _ = _get_crossings_array(
+                start_jd[negative] + 1, ra[negative], dec[negative], lon[negative], lat[negative], h, set_first,
+                skip_negative_check=True)
+            first_final[negative] = first_next + 24
+            second_final[negative] = second_next + 24
+
+    first_final[~valid] = np.nan
+    second_final[~valid] = np.nan
+    return first_final, second_final, never, always
+
+
+def get_rise_set_array(start_jd, ra, dec, lon, lat, h=0):
+    """
+    Batched get_rise_set
+    :param start_jd: Julian dates of the start of each day: array
+    :param ra: Target right ascension in hours: array
+    :param dec: Target declination in degrees: array
+    :param lon: Site longitude in degrees: array
+    :param lat: Site latitude in degrees: array
+    :param h: Altitude of the crossing in degrees: float
+    :return: Rise and set in hours after start_jd, and the never visible and always visible masks
+    """
+    return _get_crossings_array(start_jd, ra, dec, lon, lat, h, set_first=False)
+
+
+def get_set_rise_array(start_jd, ra, dec, lon, lat, h=0):
+    """
+    Batched get_set_rise
+    :param start_jd: Julian dates of the start of each day: array
+    :param ra: Target right ascension in hours: array
+    :param dec: Target declination in degrees: array
+    :param lon: Site longitude in degrees: array
+    :param lat: Site latitude in degrees: array
+    :param h: Altitude of the crossing in degrees: float
+    :return: Set and rise in hours after start_jd, and the never visible and always visible masks
+    """
+    return _get_crossings_array(start_jd, ra, dec, lon, lat, h, set_first=True)
+
+
+def _hours_to_dates(dates, hours):
+    # add decimal hours to datetime64 dates, NaN hours become NaT
+    dates = np.asarray(dates, dtype='datetime64[us]')
+    offsets = np.round(np.nan_to_num(hours) * 3600e6).astype('int64').astype('timedelta64[us]')
+    return np.where(np.isnan(hours), np.datetime64('NaT'), dates + offsets)
+
+
+def sun_set_rise_array(dates, lon, lat, sundown):
+    """
+    Batched sun_set_rise
+    :param dates: Dates to calculate for, at midnight: list of datetimes or datetime64 array
+    :param lon: Site longitudes in degrees: float or array
+    :param lat: Site latitudes in degrees: float or array
+    :param sundown: Sun altitude defining night in degrees: float
+    :return: Sunset and sunrise as datetime64 arrays, and the never set and never rise masks
+    """
+    dates = np.asarray(dates, dtype='datetime64[us]')
+    jd = timeconv.to_jd(dates)
+    sunpos = pyasl.sunpos(np.atleast_1d(jd).ravel())
+    sun_ra = sunpos[1][0].reshape(jd.shape)
+    sun_dec = sunpos[2][0].reshape(jd.shape)
+
+    set, rise, never, always = get_set_rise_array(jd, sun_ra / 15, sun_dec, lon, lat, h=sundown)
+    dates = np.broadcast_to(dates, set.shape)
+    return _hours_to_dates(dates, set), _hours_to_dates(dates, rise), never, always
+
+
+def target_rise_set_array(dates, ra, dec, lon, lat, mintargetalt):
+    """
+    Batched target_rise_set
+    :param dates: Dates to calculate for, at midnight: list of datetimes or datetime64 array
+    :param ra: Target right ascensions in degrees: float or array
+    :param dec: Target declinations in degrees: float or array
+    :param lon: Site longitudes in degrees: float or array
+    :param lat: Site latitudes in degrees: float or array
+    :param mintargetalt: Minimum target altitude in degrees: float
+    :return: Target rise and set as datetime64 arrays, and the never visible and always visible masks
+    """
+    dates = np.asarray(dates, dtype='datetime64[us]')
+    jd = timeconv.to_jd(dates)
+
+    rise, set, never, always = get_rise_set_array(jd, np.asarray(ra) / 15, dec, lon, lat, h=mintargetalt)
+    dates = np.broadcast_to(dates, rise.shape)
+    return _hours_to_dates(dates, rise), _hours_to_dates(dates, set), never, always
+
+
+# ratio of sidereal to solar time
+SIDEREAL_RATE = 1.00273790935
+
+
+def get_rise_set_lst_array(ra, dec, lat, h=0):
+
+    # input: target ra in hours, dec and site lat in degrees, altitude h in degrees
+    # return local sidereal time of rise, and sidereal hours spent above h (0 if never visible, 24 if always visible)
+    # these only depend on the target and site, not the date
+
+    ra, dec, lat = np.broadcast_arrays(np.asarray(ra, dtype=float), np.asarray(dec, dtype=float),
+                                       np.asarray(lat, dtype=float))
+    factor = (np.sin(np.radians(h)) - np.sin(np.radians(dec)) * np.sin(np.radians(lat))) / (
+            np.cos(np.radians(dec)) * np.cos(np.radians(lat)))
+    HA = np.degrees(np.arccos(np.clip(factor, -1, 1))) / 15  # hour angle in hours, clipped to 0h or 12h
+    rise_lst = np.mod(ra - HA, 24)
+    return rise_lst, 2 * HA
+
+
+def target_rise_set_lst(ra, dec, lat, mintargetalt):
+
+    # input: target ra and dec in degrees, site lat in degrees
+    # return local sidereal time of rise, and sidereal hours spent above mintargetalt
+
+    rise_lst, up_hours = get_rise_set_lst_array(ra / 15, dec, lat, h=mintargetalt)
+    return float(rise_lst), float(up_hours)
+
+
+def get_last_rise(jd, rise_lst, up_hours, lon):
+
+    # input: julian date(s), lst of rise and sidereal hours above the horizon, site longitude
+    # return solar hours since the most recent rise at or before jd, and solar hours from that rise until set
+
+    since_rise = np.mod(timeconv.gmst(jd) + lon / 15 - rise_lst, 24) / SIDEREAL_RATE
+    return since_rise, np.asarray(up_hours) / SIDEREAL_RATE
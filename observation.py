@@ -1,19 +1,23 @@
-import random
-from datetime import timedelta
-import julian
-from random import gauss
+import numpy as np
+
+import timeconv
+
+BASELINE = 45/24/60  # out of transit baseline either side of the transit, in days
 
 
 class Observation:
+    """
+    Observation of a scheduled transit. Times are held as float MJD (JD - 2400000) and durations in days
+    """
     def __init__(self, transit, number):
         self.target = transit.name
         self.center = transit.center
         if transit.ingress_visible:
-            self.start = transit.ingress - timedelta(minutes=45)
+            self.start = transit.ingress - BASELINE
         else:
             self.start = transit.visible_from
         if transit.egress_visible:
-            self.end = transit.egress + timedelta(minutes=45)
+            self.end = transit.egress + BASELINE
         else:
             self.end = transit.visible_until
         self.telescope = transit.telescope
@@ -21,36 +25,35 @@ class Observation:
 
         self.tmid = None
         self.tmid_err = None
-        self.epoch = transit.epoch
+        self.epoch = int(transit.epoch)
 
         self.telescope_used = number
 
-    def generate_data(self):
-        new_tmid_exp = julian.to_jd(self.center, fmt='jd') - 2400000
-        new_tmid = gauss(new_tmid_exp, self.duration.total_seconds() / 12 / 24 / 60 / 60)
-        new_tmid_err = abs(gauss(0.5, 0.01) / 24 / 60)
-        return self.target, self.epoch, new_tmid, new_tmid_err
-
-    def flip_unfair_coin(self, chance):
-        """
-        Determines the success of an observation by flipping a weighted coin
-        :return: Success: boolean
-        """
-        return True if random.random() < chance else False
-        # return True
-
-    def determine_success(self, total_chance):
-        block_chance = total_chance ** (1/4)
-        block_success = 0
-        fail = False
-        while block_success < 4 and not fail:
-            if self.flip_unfair_coin(block_chance):
-                block_success += 1
-            else:
-                fail = True
-        time_used = self.duration * (block_success/4)
-        if fail:
-            success = False
-        else:
-            success = True
-        return success, time_used
+
+def simulate_observations(observations, sites, rng, weather=None):
+    """
+    Simulates a batch of observations at once, looking up whether the weather is clear for each from the run's weather
+    if given, or otherwise drawing it from its site's chance of clear weather in that month, and drawing the timing
+    each one would give, scattered about its predicted center
+    :param observations: List of Observation objects
+    :param sites: Dictionary of telescope name to Telescope object, for every site in the observations
+    :param rng: Random number generator for the run: numpy Generator
+    :param weather: Weather at each site on each night of the run: NightWeather
+    :return: List of new data points generated, and the observing time used in days
+    """
+    if len(observations) == 0:
+        return [], 0
+    centers = np.array([ob.center for ob in observations])
+    durations = np.array([ob.duration for ob in observations])
+    if weather is not None:
+        clear = weather.is_clear([ob.telescope for ob in observations], centers)
+    else:
+        months = timeconv.month_index(centers)
+        chance = np.array([sites[ob.telescope].weather[month] for ob, month in zip(observations, months.tolist())])
+        clear = rng.random(len(observations)) < chance
+    tmids = rng.normal(centers, durations / 12)
+    tmid_errs = np.abs(rng.normal(0.5, 0.01, len(observations))) / 24 / 60
+
+    new_data = [(ob.target, ob.epoch, tmid, tmid_err) for ob, tmid, tmid_err, success in
+                zip(observations, tmids.tolist(), tmid_errs.tolist(), clear.tolist()) if success]
+    return new_data, float(np.sum(durations[clear]))
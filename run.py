@@ -1,9 +1,15 @@
 import argparse
-from os import getcwd, chdir, mkdir
-import threading
-import multiprocessing
+import copy
+import json
+from concurrent.futures import ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
+import shutil
+from os import getcwd, chdir, mkdir, cpu_count, listdir, makedirs, path
+
+import numpy as np
 
 import settings
+import tools
+from jobqueue import JobQueue, write_json
 
 
 def parse_arguments():
@@ -23,45 +29,366 @@ def parse_arguments():
 
 
 
-def run(process):
-    setting_data = settings.Settings('settings.dat')
-    thresholds = setting_data.threshold_value
-    networks = setting_data.telescopes
-    #args = parse_arguments()
-    #print(vars(args))
-    if setting_data.mode == 'SIMULATE':
-        starting_dir = f'{getcwd()}/simulation_data/{setting_data.directory}_{process}'
-    elif setting_data.mode == 'SCHEDULE':
-        starting_dir = f'{getcwd()}/scheduling_data/{setting_data.directory}'
+class SweepJob:
+    """
+    One repeat of the sweep described by settings.dat at one threshold, for one or more of its networks, with its own
+    copy of the settings, output directory and random seed for each network. The networks are simulated in one pass by
+    simulate.simulate_networks, sharing the parts that do not depend on the network
+    """
+    def __init__(self):
+        """
+        Null constructor
+        """
+        self.settings = None
+        self.networks = []
+        self.threshold = None
+        self.repeat = None
+        self.seeds = {}
+        self.starting_dir = None
+        self.cost = 0
+
+    def __str__(self):
+        return f'{", ".join(self.networks)} threshold {self.threshold} run {self.repeat}'
+
+    def record(self):
+        """
+        Parameters of the job for a job queue, from which init_job can fill the job again elsewhere
+        :return: dict
+        """
+        names = '+'.join(network.split('.')[0] for network in self.networks)
+        return {'id': f'{names}_{self.threshold}_{self.repeat}', 'networks': self.networks,
+                'threshold': self.threshold, 'repeat': self.repeat,
+                'seeds': [self.seeds[network] for network in self.networks]}
+
+    def init_job(self, setting_data, networks, threshold, repeat, seeds, starting_dir):
+        """
+        Fills the job, copying the settings so jobs do not share any run state
+        :param setting_data: Settings object for the sweep
+        :param networks: Names of the telescope network .csv files
+        :param threshold: Accuracy threshold
+        :param repeat: Run number, from 1
+        :param seeds: Seed for the random number generator of each network's run: list of ints
+        :param starting_dir: Directory to write the results to
+        :return: Filled SweepJob object
+        """
+        self.settings = copy.deepcopy(setting_data)
+        self.networks = list(networks)
+        self.settings.threshold_value = self.threshold = threshold
+        self.seeds = dict(zip(self.networks, seeds))
+        self.repeat = repeat
+        self.starting_dir = starting_dir
+        self.cost = sum(network_cost(setting_data, network) for network in self.networks)
+        return self
+
+
+def network_cost(setting_data, network):
+    """
+    Estimate of the time taken to simulate a network, as runs take longer with more sites to forecast for, more
+    telescopes to schedule and more days to simulate
+    :param setting_data: Settings object for the sweep
+    :param network: Name of the telescope network .csv file
+    :return: Cost, in site or telescope days: float
+    """
+    telescopes = tools.load_telescopes(f'{setting_data.data_root}/telescopes/{network}')
+    days = (setting_data.end - setting_data.start).total_seconds() / 86400
+    return (len(telescopes) + sum(telescope.copies for telescope in telescopes)) * days
+
+
+def split_networks(setting_data, chunks):
+    """
+    Splits the networks of the settings into groups of about equal cost, each the next network by cost going to the
+    group with the least so far
+    :param setting_data: Settings object for the sweep
+    :param chunks: Number of groups
+    :return: List of lists of network names, each in the order of the settings
+    """
+    costs = {network: network_cost(setting_data, network) for network in setting_data.telescopes}
+    groups = [[] for _ in range(min(chunks, len(costs)))]
+    totals = [0.] * len(groups)
+    for network in sorted(costs, key=lambda network: -costs[network]):
+        smallest = totals.index(min(totals))
+        groups[smallest].append(network)
+        totals[smallest] += costs[network]
+    return [[network for network in setting_data.telescopes if network in group] for group in groups]
+
+
+def expand_jobs(setting_data, starting_dir, workers=None):
+    """
+    Expands the settings into jobs for each threshold and repeat, with a seed for each network drawn from the SEED in
+    the settings so a sweep can be repeated, and orders them longest first so the last jobs to finish are short ones.
+    The networks of each threshold and repeat are split into as many jobs as it takes to give every worker one, or one
+    job for each network if the number of workers is not given
+    :param setting_data: Settings object for the sweep
+    :param starting_dir: Directory to write the results to
+    :param workers: Number of worker processes
+    :return: List of SweepJob objects
+    """
+    repeats = setting_data.repeats if setting_data.mode == 'SIMULATE' else 1
+    combinations = [(network, threshold, repeat) for network in setting_data.telescopes
+                    for threshold in setting_data.threshold_value for repeat in range(1, repeats + 1)]
+    seeds = np.random.SeedSequence(setting_data.seed).spawn(len(combinations))  # tied to the run, not its order
+    seeds = {combination: int(seed.generate_state(1)[0]) for combination, seed in zip(combinations, seeds)}
+    runs = len(setting_data.threshold_value) * repeats
+    chunks = len(setting_data.telescopes) if workers is None else -(-workers // runs)
+    jobs = [SweepJob().init_job(setting_data, networks, threshold, repeat,
+                                [seeds[(network, threshold, repeat)] for network in networks], starting_dir)
+            for networks in split_networks(setting_data, chunks)
+            for threshold in setting_data.threshold_value for repeat in range(1, repeats + 1)]
+    jobs.sort(key=lambda job: (-job.cost, job.threshold))
+    return jobs
+
+
+def run_job(job):
+    """
+    Runs a single job in a worker process
+    :param job: SweepJob object
+    :return: Description of the job, and the percent result of each network's simulation run, empty for the Scheduler
+    """
+    working_dir = getcwd()
+    percents = {}
+    try:
+        if job.settings.mode == 'SIMULATE':
+            import simulate
+            sweep_networks = job.settings.telescopes  # tables for every site of the sweep, for the process's later jobs
+            simulate.simulate_networks(job.settings, job.starting_dir, job.repeat, job.networks, [job.threshold],
+                                       job.seeds, sweep_networks)
+            for network in job.networks:
+                job.settings.telescopes = network
+                job.settings.obtain_directory_single()
+                percents[network] = simulate.run_percent(job.settings, job.starting_dir, job.repeat)
+        elif job.settings.mode == 'SCHEDULE':
+            import schedule
+            for network in job.networks:
+                job.settings.telescopes = network
+                schedule.schedule(job.settings)
+    finally:
+        chdir(working_dir)  # the runs change directory as they go, and workers are reused
+    return str(job), percents
+
+
+def run_adaptive(jobs, setting_data, starting_dir, workers):
+    """
+    Runs the repeats of each network and threshold until the confidence interval on the percent of its runs is
+    narrower than CI_WIDTH, running at least MIN_REPEATS and at most REPEATS of them. Each repeat of a job's networks
+    and threshold only runs the networks that have not converged, and repeats are run in order, so each run keeps its
+    seed. Processes left idle go to the jobs with a network furthest from the width
+    :param jobs: List of SweepJob objects, every repeat up to REPEATS
+    :param setting_data: Settings object for the sweep
+    :param starting_dir: Directory to write the results to
+    :param workers: Number of worker processes
+    """
+    repeats = {}  # the repeats of each group of networks and threshold, the same groups for every repeat
+    for job in sorted(jobs, key=lambda job: job.repeat):
+        repeats.setdefault((job.threshold, tuple(job.networks)), []).append(job)
+    first = max(2, min(setting_data.min_repeats, setting_data.repeats))  # an interval needs two runs
+    waiting = {group: group_jobs[first:] for group, group_jobs in repeats.items()}
+    active = {group: set(group[1]) for group in repeats}  # networks not converged
+    results = {(network, threshold): [] for threshold, networks in repeats for network in networks}
+    widths = {key: None for key in results}
+    in_flight = {group: 0 for group in repeats}
+
+    def submit(pool, running, group, job):
+        running[pool.submit(run_job, job)] = group
+        in_flight[group] += 1
+
+    def next_job(group):
+        # the next repeat, for the networks of the group that have not converged
+        job = waiting[group].pop(0)
+        networks = [network for network in job.networks if network in active[group]]
+        return SweepJob().init_job(setting_data, networks, job.threshold, job.repeat,
+                                   [job.seeds[network] for network in networks], starting_dir)
+
+    def widest(group):
+        return max(widths[(network, group[0])] for network in active[group])
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        running = {}
+        for job in jobs:  # longest first, as for a fixed number of repeats
+            if job.repeat <= first:
+                submit(pool, running, (job.threshold, tuple(job.networks)), job)
+        while running:
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                group = running.pop(future)
+                threshold = group[0]
+                in_flight[group] -= 1
+                description, percents = future.result()
+                print(f'Finished {description}')
+                for network, percent in percents.items():
+                    key = (network, threshold)
+                    if percent is not None:
+                        results[key].append(percent)
+                    if len(results[key]) < first:
+                        continue
+                    mean, half_width = tools.confidence_interval(results[key], setting_data.confidence)
+                    widths[key] = 2 * half_width
+                    if widths[key] <= setting_data.ci_width and network in active[group]:
+                        print(f'{network} threshold {threshold} converged after {len(results[key])} runs: '
+                              f'{mean:.3f} +/- {half_width:.3f}')
+                        active[group].discard(network)
+                if not active[group]:
+                    waiting[group] = []
+                if waiting[group] and in_flight[group] == 0:
+                    submit(pool, running, group, next_job(group))
+            # idle processes go to the repeats of the noisiest groups that have had their minimum
+            noisy = sorted((group for group in repeats if waiting[group] and
+                            all(widths[(network, group[0])] is not None for network in active[group])),
+                           key=lambda group: -widest(group))
+            while noisy and len(running) < workers:
+                for group in list(noisy):
+                    if len(running) >= workers:
+                        break
+                    submit(pool, running, group, next_job(group))
+                    if not waiting[group]:
+                        noisy.remove(group)
+
+    with open(f'{starting_dir}/convergence.csv', 'w') as f:
+        f.write('#Network, Threshold, Runs, MeanPercent, HalfWidth, Converged\n')
+        for (network, threshold), values in results.items():
+            if len(values) < 2:
+                f.write(f'{network}, {threshold}, {len(values)}, , , N\n')
+                continue
+            mean, half_width = tools.confidence_interval(values, setting_data.confidence)
+            converged = 'Y' if 2 * half_width <= setting_data.ci_width else 'N'
+            f.write(f'{network}, {threshold}, {len(values)}, {mean}, {half_width}, {converged}\n')
+
+
+def run(workers=None, resume=None):
+    """
+    Runs every job of the sweep in settings.dat on a pool of worker processes. The settings and the jobs are saved in
+    the sweep's directory, so a sweep that was stopped can be resumed, each run carrying on from its last checkpoint
+    and runs that had finished not run again
+    :param workers: Number of worker processes, one per core if not given
+    :param resume: Directory of a sweep to resume, a new sweep is started if not given
+    """
+    workers = workers or cpu_count()
+    if resume is None:
+        setting_data = settings.Settings('settings.dat')
+        if setting_data.mode == 'SIMULATE':
+            starting_dir = f'{getcwd()}/simulation_data/{setting_data.directory}'
+        elif setting_data.mode == 'SCHEDULE':
+            starting_dir = f'{getcwd()}/scheduling_data/{setting_data.directory}'
+        else:
+            raise Exception
+
+        mkdir(starting_dir)
+
+        jobs = expand_jobs(setting_data, starting_dir, workers)
+        shutil.copy('settings.dat', f'{starting_dir}/settings.dat')
+        write_json(f'{starting_dir}/sweep.json', [job.record() for job in jobs])
     else:
-        raise Exception
+        starting_dir = path.abspath(resume)
+        setting_data = settings.Settings(f'{starting_dir}/settings.dat')
+        setting_data.resume = True
+        with open(f'{starting_dir}/sweep.json') as f:
+            jobs = [SweepJob().init_job(setting_data, record['networks'], record['threshold'], record['repeat'],
+                                        record['seeds'], starting_dir) for record in json.load(f)]
 
-    mkdir(starting_dir)
-
-    setting_data.repeats = 1
-    count = 1
-    while count < 5:
-        for network in networks:
-            single_run_settings = setting_data
-            single_run_settings.telescopes = network
-            for value in thresholds:
-                single_run_settings.threshold_value = value
-                if setting_data.mode == 'SCHEDULE':  # schedule mode
-                    import schedule
-                    schedule.schedule(single_run_settings)
-                if setting_data.mode == 'SIMULATE':  # simulate mode
-                    import simulate
-                    simulate.simulate(single_run_settings, starting_dir, count)
-
-        count += 1
+    workers = min(workers, len(jobs))
+    if setting_data.mode == 'SIMULATE' and setting_data.ci_width > 0:
+        print(f'Running up to {len(jobs)} jobs on {workers} processes, until the {setting_data.confidence:.0%} '
+              f'intervals are narrower than {setting_data.ci_width}')
+        run_adaptive(jobs, setting_data, starting_dir, workers)
+        return
+    print(f'Running {len(jobs)} jobs on {workers} processes')
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(run_job, job) for job in jobs]  # submitted in order, so started longest first
+        for future in as_completed(futures):
+            print(f'Finished {future.result()[0]}')
     # TODO: Need to add the changes discussed with Marco et al, think about how to model amateurs
     # TODO: Think about how many targets are visible from the ground
 
+
+def create_queue(queue_dir):
+    """
+    Makes a job queue for the sweep in settings.dat in a shared directory, with a copy of the settings for the workers.
+    Each job writes its results to its own directory in the sweep's directory in simulation_data/
+    :param queue_dir: Location of the queue
+    """
+    setting_data = settings.Settings('settings.dat')
+    if setting_data.mode != 'SIMULATE':
+        print('Only simulations can be run from a job queue')
+        raise Exception
+    sweep_dir = f'{getcwd()}/simulation_data/{setting_data.directory}'
+    mkdir(sweep_dir)
+    jobs = expand_jobs(setting_data, sweep_dir)
+    queue = JobQueue(queue_dir)
+    makedirs(queue.directory, exist_ok=True)
+    shutil.copy('settings.dat', path.join(queue.directory, 'settings.dat'))
+    queue.create([job.record() for job in jobs], {'sweep_dir': sweep_dir})
+    print(queue)
+
+
+def work_queue(queue_dir):
+    """
+    Runs jobs from a job queue until it is empty
+    :param queue_dir: Location of the queue
+    :return: Number of jobs run
+    """
+    queue = JobQueue(queue_dir)
+    sweep_dir = queue.info()['sweep_dir']
+    setting_data = settings.Settings(path.join(queue.directory, 'settings.dat'))
+    setting_data.resume = True  # a job taken back from a worker that died carries on from its last checkpoint
+
+    def run_record(record):
+        job_dir = f'{sweep_dir}/jobs/{record["id"]}'
+        makedirs(job_dir, exist_ok=True)
+        run_job(SweepJob().init_job(setting_data, record['networks'], record['threshold'], record['repeat'],
+                                    record['seeds'], job_dir))
+
+    return queue.work(run_record)
+
+
+def merge_results(queue_dir):
+    """
+    Collects the results of the finished jobs of a queue into a results.csv for each network and threshold in the
+    sweep's directory, as a single process run would write them. Each run's results are read from the finished marker
+    in its run directory, which is written whole rather than appended, so a job run twice, by a worker that stalled and
+    the worker that took it back, is only counted once. Can be run at any time, merging a partial sweep
+    :param queue_dir: Location of the queue
+    """
+    queue = JobQueue(queue_dir)
+    sweep_dir = queue.info()['sweep_dir']
+    merged = {}
+    for record in queue.finished():
+        job_dir = f'{sweep_dir}/jobs/{record["id"]}'
+        for run_dir in sorted(listdir(job_dir)):
+            finished = f'{job_dir}/{run_dir}/run{record["repeat"]}/finished'
+            if path.exists(finished):
+                with open(finished) as f:
+                    result = f.read()
+                if result:
+                    merged.setdefault(run_dir, {})[record['repeat']] = result
+    for run_dir, results in merged.items():
+        makedirs(f'{sweep_dir}/{run_dir}', exist_ok=True)
+        with open(f'{sweep_dir}/{run_dir}/results.csv', 'w') as f:
+            f.writelines(results[repeat] for repeat in sorted(results))
+    print(f'{queue}, results merged into {sweep_dir}')
+
+
 def main():
-    for i in range(0, 2):
-        print(f'Starting process {i}')
-        p = multiprocessing.Process(target=run, args=(i,))
-        p.start()
+    parser = argparse.ArgumentParser(description='Runs the sweep in settings.dat on a pool of processes, or through a '
+                                                 'job queue in a directory shared by several machines')
+    parser.add_argument('-queue', help='Directory of the job queue, on a filesystem shared by the workers')
+    parser.add_argument('-init', action='store_true', help='Make the job queue from settings.dat')
+    parser.add_argument('-merge', action='store_true', help='Merge the results of the jobs finished so far')
+    parser.add_argument('-w', type=int, help='Number of worker processes, one per core if not given')
+    parser.add_argument('-resume', help='Directory of a stopped sweep to carry on with, from the runs\' checkpoints')
+    args = parser.parse_args()
+
+    if args.queue is None:
+        run(args.w, args.resume)
+    elif args.init:
+        create_queue(args.queue)
+    elif args.merge:
+        merge_results(args.queue)
+    else:
+        workers = args.w or cpu_count()
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            finished = sum(pool.map(work_queue, [args.queue] * workers))
+        print(f'{finished} jobs run on {workers} processes')
+        merge_results(args.queue)
+
 
 if __name__ == '__main__':
     main()
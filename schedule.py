@@ -10,8 +10,19 @@
 import json
 from os import getcwd
 
-
-def load_exoclock_latest(targets):
+import catalog
+import ephemeris
+import timeconv
+import transit
+from target import TargetTable, shared_forecast_cache, determine_telescope_visibility
+
+
+def load_exoclock_latest(targets, cache=None):
+    """
+    Updates the ephemerides of real targets with the latest values from the ExoClock database
+    :param targets: List of Target objects
+    :param cache: ForecastCache to drop the forecasts of updated targets from, if given
+    """
     import exoclock_database as exo
     exoclock_data = exo.ExoClock().database
     print(exoclock_data)
@@ -21,21 +32,58 @@ def load_exoclock_latest(targets):
                 latest_data = exoclock_data[target.name]
                 target.last_tmid, target.last_tmid_err = latest_data['mid_time'] - 2400000, latest_data['mid_time_error']
                 target.period, target.period_error = latest_data['period'], latest_data['period_error']
+                if cache is not None:
+                    cache.invalidate(target.name)
             except KeyError:
                 pass
 
 
-def find_required_targets(targets, date, settings):
-    required_targets = []
-    for target in targets:
-        if target.depth is not None:  # check for valid depth
-            if target.real and len(target.observable_from) > 0:  # check for real target with required depth
-                target.recalculate_parameters(date, settings)
-                if target.check_if_required(date, settings):  # run expiry calculation
-                    required_targets.append(target)  # add to list if required
+def find_required_targets(target_table, date, settings):
+    """
+    Finds the real targets with the required depth that need observing on the given date
+    :param target_table: TargetTable of all targets
+    :param date: Date to check requirement for: datetime
+    :param settings: Settings object for the current run
+    :return: List of required Targets, largest current timing error first
+    """
+    import numpy as np
+    rows = np.flatnonzero(target_table.eligible & target_table.real)  # real targets with required depth
+    target_table.recalculate_parameters(date, settings, rows)
+    rows = rows[target_table.check_if_required(date, settings)[rows]]
+    rows = rows[np.argsort(-target_table.current_err[rows], kind='stable')]  # prioritise by largest current error
+    return [target_table.targets[i] for i in rows]
+
+
+def find_followup_metrics(transits):
+    """
+    For each transit, finds the days until the next visible transit of the same target, the days until the next fully
+    visible one, and how many more are visible in the next 30 days, and adds them to the table as columns
+    :param transits: TransitTable sorted by transit center
+    """
+    import numpy as np
+    import tools
+    days_to_next_visible = np.full(len(transits), 999)
+    days_to_next_full = np.full(len(transits), 999)
+    visible_in_next_30 = np.zeros(len(transits), dtype=int)
 
-    required_targets.sort(key=lambda x: x.current_err, reverse=True)  # prioritise by largest current timing error
-    return required_targets
+    groups = tools.group_rows(transits.name)  # rows grouped by name, still in date order within each group
+    print('Names: ', len(groups))
+    for rows in groups.values():
+        centers = transits.center[rows]
+        days_to_next_visible[rows[:-1]] = np.round(np.diff(centers))
+
+        # index of the next fully visible transit after each one, len(rows) if there isn't one
+        full = transits.ingress_visible[rows] & transits.egress_visible[rows]
+        next_full = np.minimum.accumulate(np.where(full, np.arange(len(rows)), len(rows))[::-1])[::-1]
+        next_full = np.append(next_full[1:], len(rows))
+        found = next_full < len(rows)
+        days_to_next_full[rows[found]] = np.round(centers[next_full[found]] - centers[found])
+
+        visible_in_next_30[rows] = np.searchsorted(centers, centers + 30) - np.arange(len(rows)) - 1
+
+    transits.columns['days_to_next_visible'] = days_to_next_visible
+    transits.columns['days_to_next_full'] = days_to_next_full
+    transits.columns['visible_in_next_30'] = visible_in_next_30
 
 
 def schedule(settings):
@@ -54,16 +102,16 @@ def schedule(settings):
     telescope_file = settings.telescopes
     settings.simulation_method = 'SELECTIVE'
     telescopes = tools.load_telescopes(f'{settings.data_root}/telescopes/' + telescope_file)
+    if settings.forecast_cache is None:  # shared by the runs in this process
+        settings.forecast_cache = shared_forecast_cache()
     if settings.use_exoclock:
-        load_exoclock_latest(targets)
+        load_exoclock_latest(targets, settings.forecast_cache)
 
-    depth_data = np.genfromtxt(f'{settings.data_root}/starting_data/depth_limits_10.csv',
-                               delimiter=',')  # load coefficients for depth calculations
+    depth_limits = tools.load_depth_limits(
+        f'{settings.data_root}/starting_data/depth_limits_10.csv')  # load coefficients for depth calculations
+    determine_telescope_visibility(targets, telescopes, depth_limits)  # obtain usable telescopes for each target
     counter = 0
     for target in targets:
-        # target.determine_telescope_visibility(telescopes, depth_data)  # obtain usable telescopes for each target
-        for telescope in telescopes:
-            target.observable_from.append(telescope.name)  # changed: assuming are visible from all telescopes for now
         target.determine_individual_threshold(settings)  # determine individual threshold for target based on settings
         if len(target.observable_from) == 0:
             counter += 1
@@ -72,6 +120,13 @@ def schedule(settings):
 
     print('Using', len(telescopes), 'telescopes')
     print('Forecasting from', settings.start, 'until', settings.end)
+    settings.nights = ephemeris.load_or_build_nights(settings.ephemeris_cache, telescopes, settings.start,
+                                                     settings.end + interval)
+    settings.moon = ephemeris.MoonEphemeris().build(settings.start, settings.end + interval)
+    settings.visibility_stats = transit.VisibilityStats()
+    ephemeris.build_visibility_index(targets, telescopes, settings.start)
+    if settings.transit_catalog is None:  # targets updated from ExoClock drift from it and are calculated directly
+        settings.transit_catalog = catalog.load_catalog(settings.catalog_file, settings.catalog_tolerance)
     settings.obtain_directory_single()
     mkdir(settings.directory)
     chdir(settings.directory)
@@ -84,103 +139,52 @@ def schedule(settings):
         f.write('#Name, Site, Ingress(UTC), Center(UTC), Egress(UTC), IngressVisible, EgressVisible, Depth(mmag)')
         f.close()
 
-    all_transits = []
+    target_table = TargetTable(targets)
+    all_transits = transit.TransitTable()
     current_date = settings.start
     while current_date < settings.end:
-        required_targets = find_required_targets(targets, current_date, settings)
+        required_targets = find_required_targets(target_table, current_date, settings)
         print(current_date, len(required_targets))
         for target in required_targets:  # loop through needed targets
             # obtain all visible transits for required targets, with observing site
-            visible_transits = target.transit_forecast(current_date, current_date + interval, telescopes, settings)
-            for visible in visible_transits:  # add to list
-                if 'HIP41378' in visible.name:
-                    print('HIP FOUND')
-                all_transits.append(visible)
+            target.transit_forecast(current_date, current_date + interval, telescopes, settings, all_transits)
         current_date += interval
-
-
-    # determine which targets require observations
-    # required_targets = []
-    # for target in targets:
-    #     if target.depth is not None:  # check for valid depth
-    #         if target.real and len(target.observable_from) > 0:  # check for real target with required depth
-    #             target.recalculate_parameters(settings.start, settings)
-    #             if target.check_if_required(settings.start, settings):  # run expiry calculation
-    #                 required_targets.append(target)  # add to list if required
-    #
-    # required_targets.sort(key=lambda x: x.current_err, reverse=True)  # prioritise by largest current timing error
-    #
-    # for target in required_targets:  # loop through needed targets
-    #     # obtain all visible transits for required targets, with observing site
-    #     visible_transits = target.transit_forecast(settings.start, settings.end, telescopes, settings)
-    #     for visible in visible_transits:  # add to list
-    #         visible.calculate_priority(target)
-    #         all_transits.append(visible)
-    all_transits.sort(key=lambda x: x.center)  # sort by date
-
-    names = []
-    for transit in all_transits:
-        if transit.name not in names:
-            names.append(transit.name)
-
-    print('Names: ', len(names))
-    for name in names:
-        transits = [single for single in all_transits if single.name == name]
-        for i in range(0, len(transits) - 1):
-            first_date = transits[i].center
-            next_date = transits[i + 1].center
-            days_to_next = round((next_date - first_date).total_seconds()/86400)
-            transits[i].days_to_next_visible = days_to_next
-
-            found = False
-            j = i
-            while j < len(transits) - 1 and not found:
-                j += 1
-                if transits[j].ingress_visible and transits[j].egress_visible:
-                    next_full = transits[j].center
-                    found = True
-
-            if found:
-                days_to_next_full = round((next_full - first_date).total_seconds()/86400)
-                transits[i].days_to_next_full = days_to_next_full
-            else:
-                transits[i].days_to_next_full = 999
-
-            k = i
-            found = False
-            while k < len(transits) - 1 and not found:
-                k += 1
-                if (transits[k].center - transits[i].center) < timedelta(days=30):
-                    transits[i].visible_in_next_30 += 1
-                else:
-                    found = True
-
-
-
-
-
-
-        transits[-1].days_to_next_visible = 999
-        transits[-1].days_to_next_full = 999
+    all_transits.finalise()
+    print(settings.visibility_stats)
+    print(settings.forecast_cache)
+    if settings.transit_catalog is not None:
+        print(settings.transit_catalog)
+    for name in all_transits.name:
+        if 'HIP41378' in name:
+            print('HIP FOUND')
+
+    all_transits = all_transits.sort('center')  # sort by date
+    find_followup_metrics(all_transits)
 
     # output required transits
-    for single in all_transits:
+    for single in all_transits.to_transits():
         single.determine_strategy(strategy_data)
         print('series', single.series)
+        # convert times from MJD for output
+        ingress, center, egress = (timeconv.from_mjd(x).strftime("%Y-%m-%d, %H:%M:%S") for x in
+                                   (single.ingress, single.center, single.egress))
+        visible_from, visible_until = timeconv.from_mjd(single.visible_from), timeconv.from_mjd(single.visible_until)
+        run_start, run_end = (timeconv.from_mjd(x) if x is not None else None for x in
+                              (single.run_start, single.run_end))
         # output all to one document, with site data
         with open('all_telescopes.csv', 'a+') as f:
             try:
                 f.write(
-                f'\n{single.name}, {single.magnitude}, {single.telescope}, {single.ingress.strftime("%Y-%m-%d, %H:%M:%S")}, '
-                f'{single.center.strftime("%Y-%m-%d, %H:%M:%S")}, {single.egress.strftime("%Y-%m-%d, %H:%M:%S")}, '
-                f'{single.ingress_visible}, {single.egress_visible}, {single.visible_from}, {single.visible_until}, {single.run_start}, {single.run_end}, '
+                f'\n{single.name}, {single.magnitude}, {single.telescope}, {ingress}, '
+                f'{center}, {egress}, '
+                f'{single.ingress_visible}, {single.egress_visible}, {visible_from}, {visible_until}, {run_start}, {run_end}, '
                 f'{single.series["bin1"]["exp_time"]}, {single.series["bin1"]["images"]}, {single.series["bin2"]["exp_time"]}, {single.series["bin2"]["images"]}, {single.visible_fraction}, {single.depth}, {single.priority}, {single.moon_phase}, {single.moon_alt}, '
                 f'{single.period}, {single.days_to_next_visible}, {single.days_to_next_full}, {single.visible_in_next_30}')
             except KeyError:
                 f.write(
-                    f'\n{single.name}, {single.magnitude}, {single.telescope}, {single.ingress.strftime("%Y-%m-%d, %H:%M:%S")}, '
-                    f'{single.center.strftime("%Y-%m-%d, %H:%M:%S")}, {single.egress.strftime("%Y-%m-%d, %H:%M:%S")}, '
-                    f'{single.ingress_visible}, {single.egress_visible}, {single.visible_from}, {single.visible_until}, {single.run_start}, {single.run_end}, '
+                    f'\n{single.name}, {single.magnitude}, {single.telescope}, {ingress}, '
+                    f'{center}, {egress}, '
+                    f'{single.ingress_visible}, {single.egress_visible}, {visible_from}, {visible_until}, {run_start}, {run_end}, '
                     f'{None}, {None}, {None}, {None}, {single.visible_fraction}, {single.depth}, {single.priority}, {single.moon_phase}, {single.moon_alt}, '
                     f'{single.period}, {single.days_to_next_visible}, {single.days_to_next_full}, {single.visible_in_next_30}')
             # f.write('\n' + single.name + ', ' + single.telescope + ', ' + single.ingress.strftime(
@@ -193,16 +197,16 @@ def schedule(settings):
         with open(f'{single.telescope}.csv', 'a+') as f:
             try:
                 f.write(
-                    f'\n{single.name}, {single.magnitude}, {single.ingress.strftime("%Y-%m-%d, %H:%M:%S")}, '
-                    f'{single.center.strftime("%Y-%m-%d, %H:%M:%S")}, {single.egress.strftime("%Y-%m-%d, %H:%M:%S")}, '
-                    f'{single.ingress_visible}, {single.egress_visible}, {single.visible_from}, {single.visible_until}, {single.run_start}, {single.run_end}, '
+                    f'\n{single.name}, {single.magnitude}, {ingress}, '
+                    f'{center}, {egress}, '
+                    f'{single.ingress_visible}, {single.egress_visible}, {visible_from}, {visible_until}, {run_start}, {run_end}, '
                     f'{single.series["bin1"]["exp_time"]}, {single.series["bin1"]["images"]}, {single.series["bin2"]["exp_time"]}, {single.series["bin2"]["images"]}, {single.visible_fraction}, {single.depth}, {single.moon_phase}, {single.moon_alt}, '
                     f'{single.period}, {single.days_to_next_visible}, {single.days_to_next_full}, {single.visible_in_next_30}')
             except KeyError:
                 f.write(
-                    f'\n{single.name}, {single.magnitude}, {single.ingress.strftime("%Y-%m-%d, %H:%M:%S")}, '
-                    f'{single.center.strftime("%Y-%m-%d, %H:%M:%S")}, {single.egress.strftime("%Y-%m-%d, %H:%M:%S")}, '
-                    f'{single.ingress_visible}, {single.egress_visible}, {single.visible_from}, {single.visible_until}, {single.run_start}, {single.run_end}, '
+                    f'\n{single.name}, {single.magnitude}, {ingress}, '
+                    f'{center}, {egress}, '
+                    f'{single.ingress_visible}, {single.egress_visible}, {visible_from}, {visible_until}, {run_start}, {run_end}, '
                     f'{None}, {None}, {None}, {None}, {single.visible_fraction}, {single.depth}, {single.moon_phase}, {single.moon_alt}, '
                     f'{single.period}, {single.days_to_next_visible}, {single.days_to_next_full}, {single.visible_in_next_30}')
 
@@ -17,6 +17,24 @@ class Settings:
         self.use_exoclock = False
         self.moon_phase = None
         self.moon_alt = None
+        self.ephemeris_cache = None
+        self.nights = None
+        self.moon = None
+        self.visibility_stats = None
+        self.forecast_cache = None
+        self.catalog_file = None
+        self.catalog_tolerance = 0.
+        self.transit_catalog = None
+        self.seed = None
+        self.rng = None
+        self.weather = None
+        self.weather_correlation = 0.
+        self.checkpoint_blocks = 0
+        self.checkpoint_seconds = 0.
+        self.resume = False
+        self.ci_width = 0.
+        self.confidence = 0.95
+        self.min_repeats = 3
 
         setting_data = open(infile, 'r')
 
@@ -57,6 +75,26 @@ class Settings:
                         self.moon_phase = float(val)
                     elif key == 'MOON_ALT':
                         self.moon_alt = float(val)
+                    elif key == 'EPHEMERIS_CACHE':
+                        self.ephemeris_cache = val
+                    elif key == 'TRANSIT_CATALOG':
+                        self.catalog_file = val
+                    elif key == 'CATALOG_TOLERANCE':
+                        self.catalog_tolerance = float(val)
+                    elif key == 'SEED':
+                        self.seed = int(val)
+                    elif key == 'WEATHER_CORRELATION':
+                        self.weather_correlation = float(val)
+                    elif key == 'CHECKPOINT_BLOCKS':
+                        self.checkpoint_blocks = int(val)
+                    elif key == 'CHECKPOINT_SECONDS':
+                        self.checkpoint_seconds = float(val)
+                    elif key == 'CI_WIDTH':
+                        self.ci_width = float(val)
+                    elif key == 'CONFIDENCE':
+                        self.confidence = float(val)
+                    elif key == 'MIN_REPEATS':
+                        self.min_repeats = int(val)
                 except IndexError:
                     pass
 
@@ -72,6 +110,9 @@ class Settings:
         if self.telescopes is None:
             print('No Telescope file specified')
             raise Exception
+        if self.confidence not in (0.9, 0.95, 0.99):
+            print('Invalid CONFIDENCE, must be either 0.9, 0.95 or 0.99')
+            raise Exception
         if self.partial:
             print('Partial transits allowed')
         else:
@@ -1,10 +1,37 @@
 import tools
-from os import mkdir, chdir, getcwd
+import catalog
+from checkpoint import Checkpoint
+import observation
+import weather
+from target import TargetTable, shared_forecast_cache, forecast_centers, determine_telescope_visibility
+import ephemeris
+import transit
+import timeconv
+from os import mkdir, makedirs, chdir, getcwd, path
 from datetime import timedelta
 import numpy as np
 import json
 
 
+TARGET_DATABASE = 'starting_data/database_60_10_nov.json'  # under the data root
+
+
+def run_percent(settings, starting_dir, count):
+    """
+    Reads the performance of a finished run back from its directory
+    :param settings: Settings object the run was simulated with, after simulate
+    :param starting_dir: Directory the results were written to
+    :param count: Run number
+    :return: Percentage of targets not requiring observation at the end of the run, None if it has not finished: float
+    """
+    finished = starting_dir+'/'+settings.directory+'/run'+str(count)+'/finished'
+    if not path.exists(finished):
+        return None
+    with open(finished) as f:
+        result = f.read()
+    return float(result.split(',')[0]) if result else None
+
+
 def simulate(settings, starting_dir, count):
     from os import mkdir, chdir
     import tools
@@ -34,6 +61,9 @@ def simulate(settings, starting_dir, count):
     # loop for number of runs specified
 
     run_name = 'run'+str(count)  # increment run number
+    if settings.resume and path.exists(starting_dir+'/'+settings.directory+'/'+run_name+'/finished'):
+        print(f'{settings.directory}/{run_name} already finished')
+        return
     required_targets_run = run_sim(settings, settings.directory+'/'+run_name, telescopes, settings, starting_dir)  # new simulation run
     for target in required_targets_run:
         required_targets.append(target)
@@ -45,26 +75,71 @@ def simulate(settings, starting_dir, count):
         f.close()
 
 
-def find_required_targets(current, targets, settings):
+_network_tables = {}  # night and moon tables and transit catalogue of each set of sites and dates, kept by the process
+
+
+def simulate_networks(settings, starting_dir, count, networks, thresholds, seeds=None, site_networks=None):
+    """
+    Simulates each telescope network and threshold in turn, sharing the parts that do not depend on the network. The
+    night and moon tables are built once for every site in the networks, and the transits of every target at each
+    site are catalogued once, from the transit catalogue file if one is set or calculated here otherwise, so each
+    network only runs its own scheduling and observations. Transits of targets with new data are still forecast by
+    each network. The tables are kept for later calls in the same process over the same sites and dates, so the
+    networks of a sweep can be split over several calls that share them by giving every network of the sweep in
+    site_networks
+    :param settings: Settings object for the simulations
+    :param starting_dir: Directory to write the results to
+    :param count: Run number
+    :param networks: Names of the telescope network .csv files
+    :param thresholds: Accuracy thresholds to simulate each network with
+    :param seeds: Seed for the random number generator of each network's runs, settings.seed for all if not given:
+                  dictionary of network name to int
+    :param site_networks: Names of the telescope network .csv files to build the tables for the sites of, networks if
+                          not given
+    """
+    sites = catalog.catalog_sites(settings.data_root, site_networks or networks)
+    start, end = settings.start, settings.end + timedelta(days=7)  # runs forecast a week past the end
+    key = (tuple((site.name, site.lat, site.lon) for site in sites), start, end, settings.catalog_file,
+           settings.catalog_tolerance)
+    if key in _network_tables:
+        settings.nights, settings.moon, settings.transit_catalog = _network_tables[key]
+    if settings.nights is None or not settings.nights.covers(sites, start, end):
+        settings.nights = ephemeris.load_or_build_nights(settings.ephemeris_cache, sites, start, end)
+    if settings.moon is None or not settings.moon.covers(timeconv.to_jd([start, end])):
+        settings.moon = ephemeris.MoonEphemeris().build(start, end)
+    if settings.transit_catalog is None:
+        settings.transit_catalog = catalog.load_catalog(settings.catalog_file, settings.catalog_tolerance)
+    if settings.transit_catalog is None:
+        targets = tools.load_json(f'{settings.data_root}/{TARGET_DATABASE}')
+        settings.transit_catalog = catalog.TransitCatalog().build(targets, sites, start, end, nights=settings.nights,
+                                                                  moon=settings.moon)
+        settings.transit_catalog.tolerance = settings.catalog_tolerance / 24 / 60  # minutes to days
+    _network_tables[key] = settings.nights, settings.moon, settings.transit_catalog
+
+    for network in networks:
+        settings.telescopes = network
+        if seeds is not None:
+            settings.seed = seeds[network]
+        for value in thresholds:
+            settings.threshold_value = value
+            simulate(settings, starting_dir, count)
+
+
+def find_required_targets(current, target_table, settings):
     """
     For a given list of exoplanets, checks which require observations based on the current ephemeris error
     :param current: Current date that the simulation is running at: datetime
-    :param targets: List of targets in our data set: List of Target objects
+    :param target_table: TargetTable of the targets in our data set
     :param settings: Settings object for the current simulation
     :return: List of Targets that require observation, the length of the list, and total Targets
     """
-    count = 0
-    total = 0
-    required_targets = []
-    for target in targets:
-        if target.depth is not None:  # check for valid depth
-            if len(target.observable_from) > 0:  # check for real target with observable
-                total += 1
-                if target.check_if_required(current, settings):  # run check if target is required
-                    count += 1
-                    required_targets.append(target)  # add to list if required
-
-    return required_targets, count, total
+    if target_table.heap is not None:  # only targets expiring since the last step, or with new data, are checked
+        rows = target_table.expired_rows(current)
+    else:
+        # check for valid depth and real target with observable
+        rows = np.flatnonzero(target_table.eligible & target_table.check_if_required(current, settings))
+    required_targets = [target_table.targets[i] for i in rows]  # keeps the table order
+    return required_targets, len(required_targets), int(np.count_nonzero(target_table.eligible))
 
 
 def find_visible_transits(req_targets, current, interval, telescopes, settings):
@@ -75,140 +150,231 @@ def find_visible_transits(req_targets, current, interval, telescopes, settings):
     :param interval: Length of time to forecast transits over: timedelta
     :param telescopes: List of Telescope objects for the network being testes
     :param settings: Settings object for the current simulation
-    :return: List of Transit objects for visible transits across the network
+    :return: TransitTable of visible transits across the network
     """
-    visible_transits = []
-    for target in req_targets:
+    visible_transits = transit.TransitTable()
+    # transit centers in the window for all required targets at once
+    index, epochs, centers = forecast_centers([target.last_tmid for target in req_targets],
+                                              [target.period for target in req_targets],
+                                              [target.last_epoch for target in req_targets],
+                                              timeconv.to_mjd(current), timeconv.to_mjd(current + interval))
+    bounds = np.searchsorted(index, np.arange(len(req_targets) + 1))  # rows of each target, index is sorted
+    for i, target in enumerate(req_targets):
         # obtain visible transits
-        visible = target.transit_forecast(current, current + interval, telescopes, settings)
-        for single in visible:
-            visible_transits.append(single)
-    return visible_transits
+        rows = slice(bounds[i], bounds[i + 1])
+        target.check_forecast_visibility(epochs[rows], centers[rows], telescopes, settings, visible_transits)
+    return visible_transits.finalise()
 
 
 def match_transit_to_telescope(transits, telescope):
     """
     Obtain the visible Transits for a given Telescope
-    :param transits: List of Transits to be checked
+    :param transits: Dictionary of telescope name to TransitTable, from TransitTable.group_by('telescope')
     :param telescope: Telescope object currently being checked
-    :return: List of Transit objects for transits visible from the given Telescope
+    :return: TransitTable of transits visible from the given Telescope
     """
-    matching_transits = []
-    for transit in transits:
-        if transit.telescope == telescope.name:
-            matching_transits.append(transit)
-    return matching_transits
+    return transits.get(telescope.name, transit.TransitTable().finalise())
 
 
-def handle_new_data(new_data, targets, current, settings):
+def handle_new_data(new_data, targets, current, settings, target_table=None):
     """
     Handles newly generated obsservation data, stores in the relevant Target object and recalculates key parameters
     :param new_data: List of new observation data
     :param targets: List of all Targets being tested
     :param current: Current date for the simulation: datetime
     :param settings: Settings object for the current simulation
+    :param target_table: TargetTable of the Targets, used to find each Target by name, and rows of updated Targets are
+                         reloaded, if given
     """
+    if target_table is not None:
+        index, targets = target_table.index, target_table.targets  # name to row, kept for the whole run
+    else:
+        index = {target.name: i for i, target in enumerate(targets)}
     for single in new_data:
-        for target in targets:
-            if target.name == single[0]:
-                target.observations.append([single[1], single[2], single[3]])  # add new data point to target
-                # reset values to latest observation
-                target.last_epoch = single[1]
-                target.last_tmid = single[2]
-                target.last_tmid_err = single[3]
-                target.period_fit_poly()  # run period fit to refine the period error
-                # target.period_fit_deeg()
-                target.recalculate_parameters(current,
-                                              settings)  # recalculate the selection parameters based on the new data
-
-
-def run_sim(args, run_name, telescopes, settings, starting_dir):
-
+        if single[0] in index:
+            target = targets[index[single[0]]]
+            target.add_observation(single[1], single[2], single[3])  # add new data point to target
+            target.period_fit_poly()  # run period fit to refine the period error
+            # target.period_fit_deeg()
+            target.recalculate_parameters(current,
+                                          settings)  # recalculate the selection parameters based on the new data
+            if target_table is not None:
+                target_table.update(target)
+
+
+def prepare_run(args, telescopes, settings, interval):
+    """
+    Loads the targets for a run, finds the telescopes that can observe them and their selection parameters, and
+    builds the ephemeris tables shared through the run
+    :param args: Settings object holding the start and end of the run
+    :param telescopes: List of Telescope objects for the network being tested
+    :param settings: Settings object for the current simulation
+    :param interval: Length of time transits are forecast over at a time: timedelta
+    :return: List of Targets sorted by current timing error, and the TargetTable of them
+    """
     # load targets from database into objects
-    infile = f'{settings.data_root}/starting_data/database_60_10_nov.json'
-    targets = tools.load_json(infile)
+    targets = tools.load_json(f'{settings.data_root}/{TARGET_DATABASE}')
 
-    # depth_data = np.genfromtxt(f'{settings.data_root}/starting_data/depth_limits_10.csv',
-    #                           delimiter=',')  # load coefficients for depth calculations
+    depth_limits = tools.load_depth_limits(
+        f'{settings.data_root}/starting_data/depth_limits_10.csv')  # load coefficients for depth calculations
     for target in targets:
         target.determine_individual_threshold(settings)  # calculate individual threshold based on settings
-        target.recalculate_parameters(settings.start, settings)  # calculate selection parameters for target
-        # target.determine_telescope_visibility(telescopes, depth_data)
-        # Changed to make all targets visible depth-wise from all telescopes for now
-        for telescope in telescopes:
-            target.observable_from.append(telescope.name)
+    determine_telescope_visibility(targets, telescopes, depth_limits)  # telescopes that can observe each target
 
+    TargetTable(targets).recalculate_parameters(settings.start, settings)  # selection parameters for all
     targets.sort(key=lambda x: x.current_err)  # sort by current timing error
-
-    interval = timedelta(days=7)  # length of individual time blocks
-
-    # made directory for current run and cd into it
-    print(run_name)
-    mkdir(starting_dir+'/'+run_name)
-
-
-    # initialise files for scheduled observations
-    for telescope in telescopes:
-        with open(starting_dir+'/'+run_name+'/'+telescope.name+'.csv', 'w') as f:  # add header row to new files
-            f.write('#Name, Start(UTC), End(UTC)')
-            f.close()
-
-    with open(starting_dir+'/'+run_name+'/all_telescopes.csv', 'w') as f:
-        f.write('#Name, Site, Start(UTC), End(UTC)')  # add header row to new file
-        f.close()
-    #print('Using', len(telescopes), 'telescopes')
-    #print('Simulating from', args.start.date(), 'until', args.end.date())
-
+    target_table = TargetTable(targets)
+    if settings.simulation_method == 'SELECTIVE':
+        target_table.init_expiry_queue()  # required targets found from a queue of expiry dates
+
+    # sunset/sunrise for every site and night of the run, shared by the visibility checks and night counters, and
+    # moon phase and position, kept from an earlier network's run in simulate_networks if they cover this one
+    if settings.nights is None or not settings.nights.covers(telescopes, args.start, args.end + interval):
+        settings.nights = ephemeris.load_or_build_nights(settings.ephemeris_cache, telescopes, args.start,
+                                                         args.end + interval)
+    if settings.moon is None or not settings.moon.covers(timeconv.to_jd([args.start, args.end + interval])):
+        settings.moon = ephemeris.MoonEphemeris().build(args.start, args.end + interval)
+    settings.visibility_stats = transit.VisibilityStats()
+    ephemeris.build_visibility_index(targets, telescopes, args.start)  # times of year each target is up at night
+    settings.rng = np.random.default_rng(settings.seed)  # from fresh entropy if no seed is given
+    settings.weather = weather.NightWeather().build(telescopes, settings.nights, settings.rng,
+                                                    settings.weather_correlation)  # drawn once for the whole run
+    if settings.forecast_cache is None:  # shared by the runs in this process, which repeat the starting forecasts
+        settings.forecast_cache = shared_forecast_cache()
+    if settings.transit_catalog is None:  # memory mapped once, and shared by the runs and any other processes
+        settings.transit_catalog = catalog.load_catalog(settings.catalog_file, settings.catalog_tolerance)
+    return targets, target_table
+
+
+def run_blocks(args, targets, target_table, telescopes, settings, interval, checkpoint=None):
+    """
+    Runs the simulation in fixed blocks of time, finding the required targets at the start of each block, then
+    forecasting, scheduling and observing their transits over the block
+    :param args: Settings object holding the start and end of the run
+    :param targets: List of all Targets being tested
+    :param target_table: TargetTable of the Targets
+    :param telescopes: List of Telescope objects for the network being tested
+    :param settings: Settings object for the current simulation
+    :param interval: Length of each block: timedelta
+    :param checkpoint: Checkpoint to write the state to as the run goes, and to carry on from if it exists
+    :return: Total observations, total observing time in days, total night and clear night time in days, the list of
+             required Targets, their number, and the total Targets at the start of the last block
+    """
     # initialise counters
     current = args.start
     tot_obs = 0
-    tot_obs_time = timedelta(days=0)
-    tot_night_time = timedelta(days=0)
-    tot_clear_time = timedelta(days=0)
+    tot_obs_time = 0  # days
+    tot_night_time = 0
+    tot_clear_time = 0
     count, total = 0, 0
     required_targets = []
+    sites = {telescope.name: telescope for telescope in telescopes}
+
+    if checkpoint is not None and checkpoint.exists():  # carry on from the last checkpoint
+        state = checkpoint.load()
+        current = state['current']
+        tot_obs, tot_obs_time, tot_night_time, tot_clear_time = state['totals']
+        required_targets, count, total = state['required']
+        targets, target_table = state['targets'], state['target_table']
+        settings.rng.bit_generator.state = state['rng']
+        settings.weather.clear = state['weather']
+        print(f'Resuming from {current.date()}')
 
     while current < args.end:
-        required_targets, count, total = find_required_targets(current, targets, settings)
+        required_targets, count, total = find_required_targets(current, target_table, settings)
 
         print(current.date(), len(required_targets), np.round(count/total*100, 1), count, total, tot_obs)
         # obtain visible transits for the required targets
         visible_transits = find_visible_transits(required_targets, current, interval, telescopes, settings)
 
         # match transits to telescopes
+        visible_transits = visible_transits.group_by('telescope')
+        scheduled = []
         for telescope in telescopes:
-            matching_transits = match_transit_to_telescope(visible_transits, telescope)
-            matching_transits.sort(key=lambda x: x.visible_from)
+            matching_transits = match_transit_to_telescope(visible_transits, telescope).sort('visible_from')
             obs_results = telescope.schedule_observations(
                 matching_transits)  # schedule matching transits and count time used
             # increment counters
             tot_obs += obs_results[0]
+            scheduled.extend(telescope.observations)
 
-            new_data, obs_time = telescope.simulate_observations()  # simulate the scheduled observations
-            tot_obs_time += obs_time
-            # add new data
-            handle_new_data(new_data, targets, current, settings)
+        # simulate the week's scheduled observations together, then add the new data
+        new_data, obs_time = observation.simulate_observations(scheduled, sites, settings.rng, settings.weather)
+        tot_obs_time += obs_time
+        handle_new_data(new_data, targets, current, settings, target_table)
 
-        time_increments = tools.increment_total_night(current, interval, telescopes)
+        time_increments = tools.increment_total_night(current, interval, telescopes, settings.nights,
+                                                     settings.weather)
         tot_night_time += time_increments[0]
         tot_clear_time += time_increments[1]
 
         current += interval  # increment time block
 
+        if checkpoint is not None and checkpoint.due():
+            checkpoint.save({'current': current, 'totals': (tot_obs, tot_obs_time, tot_night_time, tot_clear_time),
+                             'required': (required_targets, count, total), 'targets': targets,
+                             'target_table': target_table, 'rng': settings.rng.bit_generator.state,
+                             'weather': settings.weather.clear})
+
+    return tot_obs, tot_obs_time, tot_night_time, tot_clear_time, required_targets, count, total
+
+
+def run_sim(args, run_name, telescopes, settings, starting_dir):
+
+    interval = timedelta(days=7)  # length of individual time blocks
+    targets, target_table = prepare_run(args, telescopes, settings, interval)
+
+    # made directory for current run and cd into it
+    print(run_name)
+    checkpoint = Checkpoint().init_checkpoint(starting_dir+'/'+run_name+'/checkpoint.pkl', settings.checkpoint_blocks,
+                                              settings.checkpoint_seconds)
+    resuming = settings.resume and checkpoint.exists()
+    if not resuming:
+        if settings.resume:  # stopped before its first checkpoint, start it again
+            makedirs(starting_dir+'/'+run_name, exist_ok=True)
+        else:
+            mkdir(starting_dir+'/'+run_name)
+
+        # initialise files for scheduled observations
+        for telescope in telescopes:
+            with open(starting_dir+'/'+run_name+'/'+telescope.name+'.csv', 'w') as f:  # add header row to new files
+                f.write('#Name, Start(UTC), End(UTC)')
+                f.close()
+
+        with open(starting_dir+'/'+run_name+'/all_telescopes.csv', 'w') as f:
+            f.write('#Name, Site, Start(UTC), End(UTC)')  # add header row to new file
+            f.close()
+    #print('Using', len(telescopes), 'telescopes')
+    #print('Simulating from', args.start.date(), 'until', args.end.date())
+
+    results = run_blocks(args, targets, target_table, telescopes, settings, interval,
+                         checkpoint if checkpoint.enabled() or resuming else None)
+    tot_obs, tot_obs_time, tot_night_time, tot_clear_time, required_targets, count, total = results
+
+    print(settings.visibility_stats)
+    print(settings.forecast_cache)
+    if settings.transit_catalog is not None:
+        print(settings.transit_catalog)
+
     with open(starting_dir+'/'+run_name.split('/')[0]+'/required_targets.json', 'a+') as f:
         for target in required_targets:
-            json.dump(vars(target), f)
+            json.dump(target.json_values(), f)
         f.close()
     chdir('../')  # change out of run folder
     percent = 100-(count/total*100)
     # write results for this run to results file
-    tot_obs_days = tot_obs_time.total_seconds()/86400
-    tot_night_days = tot_night_time.total_seconds()/86400
-    tot_clear_days = tot_clear_time.total_seconds()/86400
+    tot_obs_days = tot_obs_time
+    tot_night_days = tot_night_time
+    tot_clear_days = tot_clear_time
+    result = (str(percent) + ', ' + str(tot_obs) + ', ' + str(
+        tot_obs_days) + ', ' + str(tot_night_days) + ', ' + str(tot_obs_days / tot_night_days * 100) + ', ' + str(
+        tot_obs_days / tot_clear_days * 100) + '\n')
     with open(starting_dir+'/'+run_name.split('/')[0]+'/results.csv', 'a+') as f:
-        f.write(str(percent) + ', ' + str(tot_obs) + ', ' + str(
-            tot_obs_days) + ', ' + str(tot_night_days) + ', ' + str(tot_obs_days / tot_night_days * 100) + ', ' + str(
-            tot_obs_days / tot_clear_days * 100) + '\n')
+        f.write(result)
     #print(100-(count/total*100))
+    checkpoint.clear()
+    with open(starting_dir+'/'+run_name+'/finished', 'w') as f:  # not run again when a sweep is resumed
+        f.write(result)  # the run's results line, read back by the sweep
+        f.close()
 
     return required_targets
@@ -1,14 +1,16 @@
+import heapq
 import re
+from collections import OrderedDict
 
 import requests
 
 from settings import Settings
 
 import numpy as np
-import julian
-from datetime import datetime, timedelta
+import timeconv
+from datetime import datetime
 import transit
-import copy
+import ephemeris
 
 
 class Target:
@@ -35,9 +37,12 @@ class Target:
         self.depth = None
         self.real = None
         self.observations = None
+        self.history = None
         self.current_err = 0
         self.star_mag = 0
         self.observable_from = []
+        self.rise_set_lst = {}
+        self.observable_days = {}
         self.err_at_ariel = None
         self.threshold = None
 
@@ -107,6 +112,14 @@ class Target:
     def __str__(self):
         return self.name+' '+str(self.last_tmid)
 
+    def json_values(self):
+        """
+        Dictionary of the Target's values for json output, leaving out the per-site visibility caches and fit history
+        :return: dict
+        """
+        return {key: value for key, value in vars(self).items()
+                if key not in ('rise_set_lst', 'observable_days', 'history')}
+
     def find_missing_values(self):
         """
         Query exoplanets.org for missing data and store in object
@@ -219,18 +232,14 @@ class Target:
         :param threshold: Required timing accuracy at ARIEL launch: int
         :return:
         """
-        count = 0
         days_to_threshold = 0
         if self.last_tmid_err is not None:  # check for timing error available
             # if available
             err_tot = float(self.last_tmid_err)
             if err_tot < threshold/24/60:  # check we are starting below threshold
-                while err_tot < threshold/24/60:  # loop while below threshold
-                    count += 1  # count epochs
-                    # calculate next error
-                    err_tot = np.sqrt(
-                        float(self.last_tmid_err) * float(self.last_tmid_err) + count * count * float(
-                            self.period_err) * float(self.period_err))
+                # count epochs until the error reaches the threshold, and the error at that epoch
+                count = float(epochs_to_threshold(err_tot, float(self.period_err), threshold/24/60))
+                err_tot = propagated_error(err_tot, float(self.period_err), count)
                 days_to_threshold = count * float(self.period)  # convert epochs to days
             self.expiry = self.last_tmid + days_to_threshold  # add days to observation date
             self.current_err = err_tot*24*60  # calculate current error in minutes
@@ -255,7 +264,7 @@ class Target:
             self.calculate_ariel_error(current_date, settings.end)
 
     def check_if_required_initial(self, settings):
-        if self.err_at_ariel >= settings.threshold/24/60:
+        if self.err_at_ariel >= self.threshold/24/60:  # the target's own threshold, as in TargetTable
             return True
         else:
             return False
@@ -266,7 +275,7 @@ class Target:
         :param date: Current date: datetime
         :return: Result from requirement check: boolean
         """
-        date_jd = julian.to_jd(date, fmt='jd') - 2400000  # convert date to JD
+        date_jd = timeconv.to_mjd(date)  # convert date to JD
         # check for expiry
         if date_jd > self.expiry:
             return True
@@ -288,83 +297,127 @@ class Target:
             required = self.check_if_required_initial(settings)
         return required
 
-    def transit_forecast(self, start, end, telescopes, settings):
+    def transit_forecast(self, start, end, telescopes, settings, table=None):
         """
         Forecasts visible transits for the Target within the set dates at the Telescopes provided
         :param settings:
-        :param start: Start date of the window: datetime
-        :param end: End date of the window: datetime
+        :param start: Start date of the window: datetime or float MJD
+        :param end: End date of the window: datetime or float MJD
         :param telescopes: List of Telescope objects to be checked for visibility
-        :return: List of visible Transits each marked with where they should be observed from
-        """
-
-        # check dates are in correct format
-        if type(start) != datetime:
-            start = julian.from_jd(start + 2400000, fmt='jd')
-        if type(end) != datetime:
-            end = julian.from_jd(end + 2400000, fmt='jd')
-
-        # convert variables to the correct format
-        current_ephemeris = julian.from_jd(self.last_tmid + 2400000, fmt='jd')
-        period = timedelta(days=self.period)
-        epoch = int(self.last_epoch)
-
-        visible_transits = []
-        while current_ephemeris < end:  # count towards the end of the window
-            # iterate ephemeris and epoch
-            current_ephemeris += period
-            epoch += 1
-            if start < current_ephemeris < end:  # check transit is in the future
-                # create new Transit object filled with the required information, including the new ephemeris and epoch
-                candidate = transit.Transit().init_for_forecast(vars(self), current_ephemeris, epoch)
-                for telescope in telescopes:
-                    if telescope.name in self.observable_from:
-                        candidate_copy = copy.deepcopy(candidate)
-                        candidate_copy.check_transit_visibility(telescope, settings)  # check visibility against telescopes
-                        if candidate_copy.telescope == telescope.name:
-                            visible_transits.append(candidate_copy)
+        :param table: TransitTable to add the visible transits to, a new one is made and finalised if not given
+        :return: TransitTable of visible Transits each marked with where they should be observed from
+        """
 
+        # work in MJD throughout
+        if type(start) == datetime:
+            start = timeconv.to_mjd(start)
+        if type(end) == datetime:
+            end = timeconv.to_mjd(end)
+
+        _, epochs, centers = forecast_centers(self.last_tmid, self.period, self.last_epoch, start, end)
+        visible_transits = table if table is not None else transit.TransitTable()
+        self.check_forecast_visibility(epochs, centers, telescopes, settings, visible_transits)
+
+        if table is None:
+            visible_transits.finalise()
         return visible_transits
 
-    def period_fit_poly(self):
+    def check_forecast_visibility(self, epochs, centers, telescopes, settings, table):
         """
-        Runs a period fit for a target based on the available data points
-        :return:
+        Checks the visibility of forecast transits of the Target at the Telescopes provided, adding the visible ones to
+        a table. Transits held in the transit catalogue, if one is open in settings.transit_catalog, are read from it
+        :param epochs: Epochs of the transits: int array
+        :param centers: Transit centers: float MJD array
+        :param telescopes: List of Telescope objects to be checked for visibility
+        :param settings: Settings object for the current run
+        :param table: TransitTable to add the visible transits to
         """
+        catalog = settings.transit_catalog
+        if catalog is not None and catalog.check_forecast_visibility(self, epochs, centers, telescopes, settings, table):
+            return  # transits read from the catalogue
+        self.obtain_rise_set_lst(telescopes)
+        forced = 'HIP41378' in self.name  # always scheduled, so never skipped
+        stats = settings.visibility_stats
+        cache = settings.forecast_cache
+        # forecasts from an ephemeris fitted to simulated data are particular to the run, and are not kept
+        cached = cache.entry(self, telescopes, settings) if cache is not None and self.history is None else None
+
+        days = ephemeris.day_of_year(centers)
+        for epoch, current_ephemeris, day in zip(epochs.tolist(), centers.tolist(), days.tolist()):
+            if cached is not None and epoch in cached:  # already forecast with this ephemeris
+                cache.hits += 1
+                for values in cached[epoch]:
+                    table.append_values(values)
+                continue
+            visible = []
+            candidate = None
+            for telescope in telescopes:
+                if telescope.name in self.observable_from:
+                    # skip sites where the target is never up at night at this time of year
+                    observable_days = self.observable_days.get(telescope.name)
+                    if observable_days is not None and not observable_days[day] and not forced:
+                        if stats is not None:
+                            stats.record('season')
+                        continue
+                    if candidate is None:
+                        # create new Transit object filled with the required information, including the new
+                        # ephemeris and epoch
+                        candidate = transit.Transit().init_for_forecast(vars(self), current_ephemeris, epoch)
+                    # the same candidate is reused for each site, the results are recorded in the table
+                    candidate.check_transit_visibility(telescope, settings)  # check visibility against telescopes
+                    if candidate.telescope == telescope.name:
+                        table.append(candidate)
+                        visible.append(transit.TransitTable.row_values(candidate))
+            if cached is not None:
+                cache.misses += 1
+                cache.add(cached, epoch, visible)
+
+    def obtain_rise_set_lst(self, telescopes, mintargetalt=30):
+        """
+        Calculates, once per site, the local sidereal time the target rises above the minimum altitude and how long it
+        stays above it, which only depend on the target coordinates and site latitude
+        :param telescopes: List of Telescope objects to calculate for
+        :param mintargetalt: Minimum target altitude in degrees: float
+        """
+        import mini_staralt
+        for telescope in telescopes:
+            if telescope.name not in self.rise_set_lst:
+                self.rise_set_lst[telescope.name] = mini_staralt.target_rise_set_lst(
+                    self.ra, self.dec, telescope.lat, mintargetalt)
 
-        # containers for observation data
-        epochs = []
-        tmids = []
-        weights = []
-
-        # extract data from observations
-        for ob in self.observations:
-            epochs.append(ob[0])
-            tmids.append(ob[1])
-            weights.append(1/ob[2])
-
-        # attempt period fit
-        try:
-            if len(epochs) > 3:  # check for enough results
-                # run fit and extract results
-                poly_both = np.polyfit(epochs, tmids, 1, cov=True, w=weights)
-
-                poly, cov = poly_both[0], poly_both[1]
-                fit_period = poly[0]  # period
-                fit_period_err = np.sqrt(cov[0][0])  # calculate error
+    def add_observation(self, epoch, tmid, tmid_err):
+        """
+        Stores a new timing and makes it the latest data for the target
+        :param epoch: Epoch of the transit: int
+        :param tmid: Transit center: float MJD
+        :param tmid_err: Error on the transit center in days: float
+        """
+        self.observations.append([epoch, tmid, tmid_err])  # add new data point to target
+        # reset values to latest observation
+        self.last_epoch = epoch
+        self.last_tmid = tmid
+        self.last_tmid_err = tmid_err
 
+    def period_fit_poly(self):
+        """
+        Runs a weighted linear fit of the transit centers against epoch for the available data points, storing the
+        period and its error. Gives the same result as np.polyfit with cov=True, but from running sums kept in
+        self.history, which only takes in the observations added since the last fit. Timings that can not be weighted are
+        left out, and the previous period kept if the timings do not constrain one
+        :return:
+        """
+        if self.history is None:
+            self.history = ObservationHistory().init_reference(self.period)
+        for ob in self.observations[self.history.seen:]:
+            self.history.add(ob[0], ob[1], ob[2])
+
+        if len(self.history) > 3:  # check for enough results
+            result = self.history.fit()
+            if result is not None:
                 # store in object
-                self.period = fit_period
-                self.period_err = fit_period_err
+                self.period, self.period_err = result
                 #print('Poly:', self.period, self.period_err)
 
-        except ValueError:
-            pass
-        except np.linalg.LinAlgError:
-            pass
-        except TypeError:
-            pass
-
     # def period_fit_deeg(self):
     #     if len(self.observations) < 3:
     #         print('Insufficient observations for period fit')
@@ -385,34 +438,507 @@ class Target:
     #         period_err = 12*avg_err*avg_err/(n_obs*n_obs*n_obs - n_obs)
     #         print('Deeg:', period, period_err)
 
-    def determine_telescope_visibility(self, telescopes, depth_data):
+    def determine_telescope_visibility(self, telescopes, depth_limits):
         """
         Determines which telescopes are capable of observing this target's transit, based on the depth, and the star
         magnitude
         :param telescopes: List of Telescope objects to be used
-        :param depth_data: List of coefficients that describe the relationship between star magnitude and minimum
-                           observable transit depth for a given telescope aperture and transit duration
+        :param depth_limits: DepthLimits grid of the coefficients that describe the relationship between star
+                             magnitude and minimum observable transit depth for a given telescope aperture and transit
+                             duration
         :return:
         """
-        duration_hours = np.round(self.duration/60, 1)  # round duration to 6 minutes, 0.1 hours
-        for telescope in telescopes:  # loop through telescopes
-            aperture = np.round(telescope.aperture, 2)  # round aperture to 0.05 m
-            for row in depth_data:  # loop through data
-                if aperture == row[0] and duration_hours == row[1]:  # check for correct row
-                    # extract coefficients
-                    a = row[2]
-                    b = row[3]
-                    # calculate depth limit
-                    depth_limit = a*np.exp(b*self.star_mag)*10  # *10 to convert from % to mmag
-
-                    # check if transit is deep enough
-                    try:
-                        self.depth = float(self.depth)  # check for null value
-                        if self.depth > depth_limit:
-                            self.observable_from.append(telescope.name)  # add telescope name to approved list
-                    except TypeError:
-                        pass
+        determine_telescope_visibility([self], telescopes, depth_limits)
+
+
+def determine_telescope_visibility(targets, telescopes, depth_limits):
+    """
+    Determines which telescopes are capable of observing each target's transit, based on the depth and the star
+    magnitude, for the whole catalogue at once. Telescope names are added to each target's observable_from
+    :param targets: List of Target objects
+    :param telescopes: List of Telescope objects to be used
+    :param depth_limits: DepthLimits grid of depth limit coefficients
+    """
+    # check for null values
+    depths = np.full(len(targets), np.nan)
+    for i, single in enumerate(targets):
+        if single.depth is not None:
+            single.depth = float(single.depth)
+            depths[i] = single.depth
+    durations = np.array([single.duration for single in targets], dtype=float)/60
+    mags = np.array([single.star_mag for single in targets], dtype=float)
+
+    for telescope in telescopes:  # loop through telescopes
+        depth_limit = depth_limits.depth_limit(telescope.aperture, durations, mags)
+        for i in np.flatnonzero(depths > depth_limit):  # check if transit is deep enough
+            targets[i].observable_from.append(telescope.name)  # add telescope name to approved list
+
+
+class DepthLimits:
+    """
+    Grid of the depth limit coefficients a and b, where the minimum observable depth is a*exp(b*mag), indexed by
+    telescope aperture and transit duration. Apertures are rounded to 0.01 m and durations to 0.1 hours as in the
+    table, and values between grid points are interpolated. Outside the grid there is no limit available, and so no
+    depth is observable
+    """
+    def __init__(self):
+        """
+        Null constructor
+        """
+        self.apertures = None
+        self.durations = None
+        self.a = None
+        self.b = None
+
+    def load(self, filename):
+        """
+        Fills the grid from a .csv file of aperture (m), duration (hours), a and b
+        :param filename: Location of the depth limits file
+        :return: Filled DepthLimits object
+        """
+        data = np.genfromtxt(filename, delimiter=',')
+        self.apertures, aperture_index = np.unique(data[:, 0], return_inverse=True)
+        self.durations, duration_index = np.unique(data[:, 1], return_inverse=True)
+        self.a = np.full((len(self.apertures), len(self.durations)), np.nan)  # missing combinations have no limit
+        self.b = np.full((len(self.apertures), len(self.durations)), np.nan)
+        self.a[aperture_index, duration_index] = data[:, 2]
+        self.b[aperture_index, duration_index] = data[:, 3]
+        return self
+
+    def coefficients(self, aperture, duration):
+        """
+        Looks up the coefficients, interpolating between grid points
+        :param aperture: Telescope aperture in m: float or array
+        :param duration: Transit duration in hours: float or array
+        :return: Coefficients a and b, NaN outside the grid
+        """
+        aperture = np.round(aperture, 2)  # round aperture to 0.01 m
+        duration = np.round(duration, 1)  # round duration to 6 minutes, 0.1 hours
+        # fractional position on each axis
+        i = np.interp(aperture, self.apertures, np.arange(len(self.apertures)), left=np.nan, right=np.nan)
+        j = np.interp(duration, self.durations, np.arange(len(self.durations)), left=np.nan, right=np.nan)
+        outside = np.isnan(i) | np.isnan(j)
+        i, j = np.where(outside, 0, i), np.where(outside, 0, j)
+        i0 = np.minimum(np.floor(i).astype(int), len(self.apertures) - 2)
+        j0 = np.minimum(np.floor(j).astype(int), len(self.durations) - 2)
+        di, dj = i - i0, j - j0
+
+        def bilinear(grid):
+            return ((1 - di) * ((1 - dj) * grid[i0, j0] + dj * grid[i0, j0 + 1]) +
+                    di * ((1 - dj) * grid[i0 + 1, j0] + dj * grid[i0 + 1, j0 + 1]))
+        return np.where(outside, np.nan, bilinear(self.a)), np.where(outside, np.nan, bilinear(self.b))
+
+    def depth_limit(self, aperture, duration, mag):
+        """
+        Minimum observable transit depth
+        :param aperture: Telescope aperture in m: float or array
+        :param duration: Transit duration in hours: float or array
+        :param mag: Star magnitude: float or array
+        :return: Depth limit in mmag, NaN outside the grid
+        """
+        a, b = self.coefficients(aperture, duration)
+        return a*np.exp(b*mag)*10  # *10 to convert from % to mmag
+
+
+class ObservationHistory:
+    """
+    Timings of a target held in NumPy buffers that grow as needed, with running weighted sums for a linear fit of
+    transit center against epoch. Each timing is weighted by 1/error^2, as np.polyfit with w=1/error. The sums are
+    taken about a reference ephemeris, and updated with West's weighted mean and variance algorithm, so the fit keeps
+    full precision however many timings are added
+    """
+    def __init__(self):
+        """
+        Null constructor
+        """
+        self.epochs = np.zeros(16, dtype=int)
+        self.tmids = np.zeros(16)
+        self.errs = np.zeros(16)
+        self.n = 0
+        self.seen = 0  # timings offered to add, including those skipped
+        self.ref_period = 0.
+        self.ref_epoch = None
+        self.ref_tmid = None
+        self.weight = 0.  # sum of weights
+        self.mean_x = 0.  # weighted means of epoch and timing offset from the reference
+        self.mean_y = 0.
+        self.sxx = 0.  # weighted sums of squares and products of deviations from the means
+        self.sxy = 0.
+        self.syy = 0.
+
+    def __len__(self):
+        return self.n
+
+    def init_reference(self, period):
+        """
+        Sets the period of the reference ephemeris the timings are taken relative to
+        :param period: Period in days, the current estimate: float
+        :return: ObservationHistory object
+        """
+        self.ref_period = float(period) if period is not None else 0.
+        return self
+
+    def add(self, epoch, tmid, tmid_err):
+        """
+        Stores a timing and updates the running sums. Timings with a missing value, or an error that is not positive,
+        can not be weighted and are skipped, as they made the direct fit fail
+        :param epoch: Epoch of the transit: int
+        :param tmid: Transit center: float MJD
+        :param tmid_err: Error on the transit center in days: float
+        :return: Whether the timing was used: boolean
+        """
+        self.seen += 1
+        try:
+            valid = np.isfinite([epoch, tmid, tmid_err]).all() and tmid_err > 0
+        except TypeError:  # None, or not a number
+            valid = False
+        if not valid:
+            return False
+        if self.n == len(self.epochs):  # double the buffers when full
+            self.epochs = np.concatenate((self.epochs, np.zeros_like(self.epochs)))
+            self.tmids = np.concatenate((self.tmids, np.zeros_like(self.tmids)))
+            self.errs = np.concatenate((self.errs, np.zeros_like(self.errs)))
+        self.epochs[self.n], self.tmids[self.n], self.errs[self.n] = epoch, tmid, tmid_err
+        self.n += 1
+
+        if self.ref_epoch is None:  # the first timing fixes the reference ephemeris
+            self.ref_epoch, self.ref_tmid = int(epoch), float(tmid)
+        x = float(epoch - self.ref_epoch)
+        y = float(tmid) - self.ref_tmid - self.ref_period * x
+        w = 1 / (float(tmid_err) * float(tmid_err))
+
+        self.weight += w
+        dx = x - self.mean_x
+        dy = y - self.mean_y
+        self.mean_x += w / self.weight * dx
+        self.mean_y += w / self.weight * dy
+        self.sxx += w * dx * (x - self.mean_x)
+        self.sxy += w * dx * (y - self.mean_y)
+        self.syy += w * dy * (y - self.mean_y)
+        return True
+
+    def fit(self):
+        """
+        Weighted linear fit of the timings, with the period error from the covariance scaled by the reduced chi squared
+        as np.polyfit does with cov=True
+        :return: Period and period error in days, or None if the epochs do not constrain a period
+        """
+        if self.n <= 2 or not self.sxx > 0:  # singular, all the timings at one epoch
+            return None
+        slope = self.sxy / self.sxx
+        chi2 = max(self.syy - slope * self.sxy, 0.)  # weighted sum of squared residuals
+        period, period_err = self.ref_period + slope, np.sqrt(chi2 / (self.n - 2) / self.sxx)
+        if not (np.isfinite(period) and np.isfinite(period_err)):
+            return None
+        return period, period_err
+
 
+class ForecastCache:
+    """
+    Visible transits already forecast, so a target's transits are only checked for visibility once for each ephemeris.
+    Entries are keyed on the target name and its ephemeris, the telescopes and the settings used by the visibility
+    checks, and hold the table rows found for each epoch checked. Only forecasts from a target's starting ephemeris,
+    before any simulated data, are held, as every run in a process repeats these, and the cache is shared by the runs
+    through shared_forecast_cache. Entries for a target are dropped with invalidate when its starting ephemeris is
+    replaced, and the least recently used entries are evicted once more than max_epochs epochs are held
+    """
+    def __init__(self, max_epochs=500000):
+        """
+        Empty cache
+        :param max_epochs: Number of epochs to hold before evicting entries: int
+        """
+        self.entries = OrderedDict()  # key to dictionary of epoch to list of row values, least recently used first
+        self.names = {}  # target name to the keys of its entries
+        self.max_epochs = max_epochs
+        self.n_epochs = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __str__(self):
+        return f'Forecast cache: {self.hits} hits, {self.misses} misses, {len(self.entries)} entries, ' \
+               f'{self.n_epochs} epochs'
+
+    def entry(self, single, telescopes, settings):
+        """
+        Finds the entry for a target's current ephemeris, making a new empty one if there isn't one
+        :param single: Target object
+        :param telescopes: List of Telescope objects being checked
+        :param settings: Settings object for the current run
+        :return: Dictionary of epoch to list of row values
+        """
+        key = (single.name, float(single.last_tmid), float(single.period), int(single.last_epoch),
+               tuple((telescope.name, telescope.lat, telescope.lon) for telescope in telescopes),
+               tuple(single.observable_from), settings.partial, settings.moon_phase, settings.moon_alt)
+        if key in self.entries:
+            self.entries.move_to_end(key)
+        else:
+            self.entries[key] = {}
+            self.names.setdefault(single.name, set()).add(key)
+        return self.entries[key]
+
+    def add(self, cached, epoch, rows):
+        """
+        Stores the rows found for an epoch in an entry, evicting the least recently used entries if over the limit
+        :param cached: Entry from entry
+        :param epoch: Epoch of the transit: int
+        :param rows: Row values of the visible transits: list of tuples
+        """
+        cached[epoch] = rows
+        self.n_epochs += 1
+        while self.n_epochs > self.max_epochs and len(self.entries) > 1:
+            key, evicted = self.entries.popitem(last=False)
+            self.n_epochs -= len(evicted)
+            self.names[key[0]].discard(key)
+
+    def invalidate(self, name):
+        """
+        Drops all entries for a target, called when its ephemeris is updated
+        :param name: Name of the target
+        """
+        for key in self.names.pop(name, ()):
+            self.n_epochs -= len(self.entries.pop(key))
+
+
+_forecast_cache = None  # ForecastCache shared by the runs in this process
+
+
+def shared_forecast_cache():
+    """
+    The ForecastCache of this process, made on first use, so runs in the same process, and in the same pool worker,
+    reuse the forecasts of each other's starting ephemerides
+    :return: ForecastCache object
+    """
+    global _forecast_cache
+    if _forecast_cache is None:
+        _forecast_cache = ForecastCache()
+    return _forecast_cache
+
+
+def propagated_error(tmid_err, period_err, epochs):
+    """
+    Timing error propagated forward from the last observation
+    :param tmid_err: Timing error of the last observation in days: float or array
+    :param period_err: Period error in days: float or array
+    :param epochs: Number of epochs propagated over: float or array
+    :return: Timing error in days
+    """
+    return np.sqrt(tmid_err * tmid_err + epochs * epochs * period_err * period_err)
+
+
+def epochs_to_threshold(tmid_err, period_err, threshold):
+    """
+    Number of epochs until the propagated timing error reaches the threshold, solved directly rather than counting
+    epochs one at a time: the smallest count of at least 1 whose error is not below the threshold, or 0 if the error
+    starts at or above it
+    :param tmid_err: Timing error of the last observation in days: float or array
+    :param period_err: Period error in days: float or array
+    :param threshold: Threshold in days: float or array
+    :return: Number of epochs, inf if the period error is zero: float or array
+    """
+    tmid_err, period_err, threshold = np.broadcast_arrays(np.asarray(tmid_err, dtype=float),
+                                                          np.asarray(period_err, dtype=float),
+                                                          np.asarray(threshold, dtype=float))
+    period_err = np.abs(period_err)  # only the square enters the error, some catalogue values are negative
+    below = tmid_err < threshold
+    with np.errstate(divide='ignore', invalid='ignore'):
+        count = np.ceil(np.sqrt(np.maximum(threshold * threshold - tmid_err * tmid_err, 0)) / period_err)
+    count = np.where(below, np.maximum(count, 1), 0)
+
+    # step by one where rounding put the solution either side of the boundary
+    finite = np.isfinite(count) & below
+    count = np.where(finite & (propagated_error(tmid_err, period_err, count) < threshold), count + 1, count)
+    count = np.where(finite & (count > 1) & (propagated_error(tmid_err, period_err, count - 1) >= threshold),
+                     count - 1, count)
+    return count
+
+
+def forecast_centers(last_tmid, period, last_epoch, start, end):
+    """
+    Transit centers strictly between two dates for one or more targets, with the first epoch in the window found
+    directly from the last timing rather than stepping through every epoch since. Only epochs after the last timing
+    are included
+    :param last_tmid: Last transit center of each target: float MJD or array
+    :param period: Period of each target in days: float or array
+    :param last_epoch: Epoch of the last transit center of each target: int or array
+    :param start: Start of the window: float MJD
+    :param end: End of the window: float MJD
+    :return: Flat arrays of target index, epoch and transit center, in order of target then epoch
+    """
+    last_tmid = np.atleast_1d(np.asarray(last_tmid, dtype=float))
+    period = np.atleast_1d(np.asarray(period, dtype=float))
+    last_epoch = np.atleast_1d(np.asarray(last_epoch, dtype=int))
+
+    # first and last epochs after the last timing inside the window, stepped by one where rounding missed the edge
+    first = np.maximum(np.floor((start - last_tmid) / period) + 1, 1)
+    first = np.where(last_tmid + first * period <= start, first + 1, first)
+    first = np.where((first > 1) & (last_tmid + (first - 1) * period > start), first - 1, first)
+    last = np.ceil((end - last_tmid) / period) - 1
+    last = np.where(last_tmid + last * period >= end, last - 1, last)
+    last = np.where(last_tmid + (last + 1) * period < end, last + 1, last)
+
+    counts = np.maximum(last - first + 1, 0).astype(int)
+    index = np.repeat(np.arange(len(last_tmid)), counts)
+    steps = first[index] + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    centers = last_tmid[index] + steps * period[index]
+    return index, last_epoch[index] + steps.astype(int), centers
+
+
+class TargetTable:
+    """
+    Columnar copy of the ephemeris data of a list of Targets, used to calculate expiry dates and errors and to select
+    the required targets for all targets at once. Results are written back to the Target objects, and a row is
+    reloaded from its Target with update when the Target gets new data
+    """
+    def __init__(self, targets):
+        """
+        Builds the table from a list of Target objects, keeping their order
+        :param targets: List of Target objects, with their individual thresholds determined
+        """
+        self.targets = targets
+        self.index = {single.name: i for i, single in enumerate(targets)}
+        n = len(targets)
+        self.period = np.zeros(n)
+        self.period_err = np.zeros(n)
+        self.last_tmid = np.zeros(n)
+        self.last_tmid_err = np.zeros(n)
+        self.last_epoch = np.zeros(n, dtype=int)
+        self.has_err = np.zeros(n, dtype=bool)
+        self.threshold = np.zeros(n)
+        self.expiry = np.zeros(n)
+        self.current_err = np.zeros(n)
+        self.err_at_ariel = np.full(n, np.inf)
+        self.eligible = np.zeros(n, dtype=bool)
+        self.real = np.array([bool(single.real) for single in targets], dtype=bool)
+        self.forced = np.array([single.name.split('_')[0] == 'HIP41378f' for single in targets], dtype=bool)
+        self.heap = None  # expiry queue, see init_expiry_queue
+        self.version = None
+        self.expired = None
+        for i in range(n):
+            self.load_row(i)
+
+    def __len__(self):
+        return len(self.targets)
+
+    def load_row(self, i):
+        """
+        Copies the current values of one Target into the table
+        :param i: Row number
+        """
+        single = self.targets[i]
+        self.has_err[i] = single.last_tmid_err is not None
+        self.period[i] = float(single.period)
+        self.period_err[i] = float(single.period_err) if single.period_err is not None else np.nan
+        self.last_tmid[i] = float(single.last_tmid)
+        self.last_epoch[i] = int(single.last_epoch)
+        self.last_tmid_err[i] = float(single.last_tmid_err) if self.has_err[i] else np.nan
+        self.threshold[i] = float(single.threshold) if single.threshold is not None else np.nan
+        self.expiry[i] = float(single.expiry) if single.expiry is not None else 0
+        self.current_err[i] = float(single.current_err) if single.current_err is not None else 0
+        self.err_at_ariel[i] = float(single.err_at_ariel) if single.err_at_ariel is not None else np.inf
+        self.eligible[i] = single.depth is not None and len(single.observable_from) > 0
+        self.requeue(i)
+
+    def update(self, single):
+        """
+        Reloads the row of a Target whose data has changed
+        :param single: Target object
+        """
+        self.load_row(self.index[single.name])
 
+    def calculate_expiry(self, rows=None):
+        """
+        Calculates expiry dates and current errors as Target.calculate_expiry, for the rows given or all rows
+        :param rows: Row numbers to calculate for: array
+        """
+        rows = np.arange(len(self)) if rows is None else np.asarray(rows, dtype=int)
+        tmid_err, period_err = self.last_tmid_err[rows], self.period_err[rows]
+        count = epochs_to_threshold(tmid_err, period_err, self.threshold[rows]/24/60)
+        err_tot = np.where(count > 0, propagated_error(tmid_err, period_err, count), tmid_err)
+
+        # no timing error available, or forced, set expiry and error to always get selected
+        always = ~self.has_err[rows] | self.forced[rows]
+        self.expiry[rows] = np.where(always, 0, self.last_tmid[rows] + count * self.period[rows])
+        self.current_err[rows] = np.where(always, 100000, err_tot*24*60)
+        for i in rows:
+            self.targets[i].expiry = float(self.expiry[i])
+            self.targets[i].current_err = float(self.current_err[i])
+            self.requeue(i)
+
+    def calculate_ariel_error(self, current_date, end_date, rows=None):
+        """
+        Calculates the propagated error at the end date as Target.calculate_ariel_error, for the rows given or all rows
+        :param current_date: Current date in the simulation: datetime
+        :param end_date: Date to calculate the propagated error for: datetime
+        :param rows: Row numbers to calculate for: array
+        """
+        rows = np.arange(len(self)) if rows is None else np.asarray(rows, dtype=int)
+        remaining_epochs = (end_date - current_date).total_seconds()/86400/self.period[rows]
+        err = propagated_error(self.last_tmid_err[rows], self.period_err[rows], remaining_epochs)
+        self.err_at_ariel[rows] = np.where(self.has_err[rows], err, np.inf)
+        for i in rows:
+            self.targets[i].err_at_ariel = float(self.err_at_ariel[i])
+
+    def recalculate_parameters(self, current_date, settings, rows=None):
+        """
+        Recalculates the parameters required for the selection method being used, as Target.recalculate_parameters
+        :param current_date: Date to make calculation for: datetime
+        :param settings: Settings object for the current run
+        :param rows: Row numbers to calculate for: array
+        """
+        if settings.simulation_method == 'SELECTIVE':
+            self.calculate_expiry(rows)
+        elif settings.simulation_method == 'INITIAL':
+            self.calculate_ariel_error(current_date, settings.end, rows)
 
+    def init_expiry_queue(self):
+        """
+        Starts keeping the eligible rows in a min-heap by expiry date, so finding the expired targets only looks at
+        those that expired since the last check, and those whose expiry has changed. Used with the Selective method
+        :return: TargetTable object
+        """
+        self.version = np.zeros(len(self), dtype=int)
+        self.expired = set()
+        self.heap = [(float(self.expiry[i]), int(i), 0) for i in np.flatnonzero(self.eligible)
+                     if not np.isnan(self.expiry[i])]
+        heapq.heapify(self.heap)
+        return self
 
+    def requeue(self, i):
+        """
+        Puts a row back in the expiry queue after its expiry has changed. The row's older entry in the heap is left in
+        place and skipped when it is reached
+        :param i: Row number
+        """
+        if self.heap is None:
+            return
+        self.version[i] += 1
+        self.expired.discard(i)
+        if self.eligible[i] and not np.isnan(self.expiry[i]):
+            heapq.heappush(self.heap, (float(self.expiry[i]), int(i), int(self.version[i])))
+
+    def expired_rows(self, date):
+        """
+        Finds the eligible rows whose expiry is before the date given, from the expiry queue
+        :param date: Current date: datetime
+        :return: Row numbers of expired targets, in table order: list
+        """
+        date_mjd = timeconv.to_mjd(date)
+        while self.heap and self.heap[0][0] < date_mjd:  # check for expiry
+            _, i, version = heapq.heappop(self.heap)
+            if version == self.version[i]:  # skip entries replaced by a later expiry
+                self.expired.add(i)
+        return sorted(self.expired)
+
+    def check_if_required(self, date, settings):
+        """
+        Requirement check of every row, as Target.check_if_required. The Initial method compares against each
+        target's individual threshold
+        :param date: Current date, used by Selective method: datetime
+        :param settings: Settings object for the current run
+        :return: Result of the requirement check for each row: boolean array
+        """
+        if settings.simulation_method == 'SELECTIVE':
+            return timeconv.to_mjd(date) > self.expiry
+        elif settings.simulation_method == 'INITIAL':
+            return self.err_at_ariel >= self.threshold/24/60
+        return np.zeros(len(self), dtype=bool)
@@ -0,0 +1,103 @@
+#################################################################
+# Conversions between datetimes, Julian dates and sidereal time.
+# Every function takes a single value or an array, and returns
+# the same. MJD throughout follows the convention used by the
+# target database, JD - 2400000.
+#################################################################
+import numpy as np
+from datetime import datetime, timedelta
+
+JD_UNIX_EPOCH = 2440587.5  # Julian date of 1970-01-01T00:00:00
+MJD_OFFSET = 2400000  # MJD as stored for targets and observations: JD - 2400000
+UNIX_EPOCH = datetime(year=1970, month=1, day=1)
+NUMPY_EPOCH = np.datetime64('1970-01-01T00:00:00', 'us')
+
+
+def to_jd(dates):
+    """
+    Converts dates to Julian dates
+    :param dates: datetime, list of datetimes, or datetime64 array
+    :return: Julian date(s): float or array
+    """
+    if isinstance(dates, datetime):
+        return (dates - UNIX_EPOCH) / timedelta(days=1) + JD_UNIX_EPOCH
+    dates = np.asarray(dates, dtype='datetime64[us]')
+    return (dates - NUMPY_EPOCH) / np.timedelta64(1, 'D') + JD_UNIX_EPOCH
+
+
+def from_jd(jd):
+    """
+    Converts Julian dates to dates
+    :param jd: Julian date(s): float or array
+    :return: datetime for a single value, datetime64 array otherwise
+    """
+    if np.ndim(jd) == 0:
+        return UNIX_EPOCH + timedelta(days=float(jd) - JD_UNIX_EPOCH)
+    offsets = np.round((np.asarray(jd, dtype=float) - JD_UNIX_EPOCH) * 86400e6).astype('int64')
+    return NUMPY_EPOCH + offsets.astype('timedelta64[us]')
+
+
+def to_mjd(dates):
+    """
+    Converts dates to MJD, JD - 2400000
+    :param dates: datetime, list of datetimes, or datetime64 array
+    :return: MJD(s): float or array
+    """
+    return to_jd(dates) - MJD_OFFSET
+
+
+def from_mjd(mjd):
+    """
+    Converts MJD, JD - 2400000, to dates
+    :param mjd: MJD(s): float or array
+    :return: datetime for a single value, datetime64 array otherwise
+    """
+    return from_jd(np.add(mjd, MJD_OFFSET))
+
+
+def month_index(mjd):
+    """
+    Month of the year a time falls in, for looking up monthly values
+    :param mjd: MJD(s): float or array
+    :return: Month, 0 for January to 11 for December: int or array
+    """
+    months = np.asarray(from_mjd(np.atleast_1d(mjd))).astype('datetime64[M]').astype(int) % 12
+    return int(months[0]) if np.ndim(mjd) == 0 else months
+
+
+def gmst(jd):
+    """
+    Greenwich mean sidereal time
+    :param jd: Julian date(s): float or array
+    :return: GMST in decimal hours
+    """
+    jd = np.asarray(jd, dtype=float)
+    du = jd - 2451545
+    du_mod = np.fmod(du, 1)
+    T = du / 36525
+    gmst_sec = 86400 * (
+                0.7790572732640 + 0.00273781191135448 * du + du_mod) + 0.00096707 + 307.47710227 * T + 0.092772113 * (
+                           T ** 2) - 0.0000000293 * (T ** 3) + 0.00000199707 * (T ** 4) - 0.000000002453 * (T ** 5)
+    return np.fmod(gmst_sec / 3600, 24)
+
+
+def lst(jd, lon):
+    """
+    Local mean sidereal time
+    :param jd: Julian date(s): float or array
+    :param lon: Site longitude in degrees, east positive: float or array
+    :return: LST in decimal hours
+    """
+    return np.mod(gmst(jd) + np.asarray(lon) / 15, 24)
+
+
+def gmst_utc_diff(jd):
+    """
+    Difference between GMST and UTC, subtracting the east longitude from this gives the LST/UTC difference
+    :param jd: Julian date(s): float or array
+    :return: GMST - UTC in decimal hours, between 0 and 24
+    """
+    jd = np.asarray(jd, dtype=float)
+    utc = np.mod(jd - 0.5, 1) * 24  # UTC in decimal format
+    diff = gmst(jd) - utc
+    return np.where(diff < 0, diff + 24, diff)
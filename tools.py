@@ -30,6 +30,37 @@ def load_telescopes(filename):
     return telescopes
 
 
+def group_rows(keys):
+    """
+    Groups row numbers by key in a single pass, keeping the original order of the rows within each group
+    :param keys: Key of each row: array
+    :return: Dictionary of key to array of row numbers, with keys in sorted order
+    """
+    import numpy as np
+    keys = np.asarray(keys)
+    if len(keys) == 0:
+        return {}
+    values, inverse = np.unique(keys, return_inverse=True)
+    order = np.argsort(inverse, kind='stable')  # rows grouped by key, in their original order within each group
+    groups = np.split(order, np.cumsum(np.bincount(inverse, minlength=len(values)))[:-1])
+    return {value.item() if isinstance(value, np.generic) else value: rows for value, rows in zip(values, groups)}
+
+
+_depth_limits = {}  # DepthLimits already loaded, by file name
+
+
+def load_depth_limits(filename):
+    """
+    Loads the depth limit coefficients from a .csv file into a DepthLimits grid, only reading each file once
+    :param filename: location of data file to be loaded
+    :return: DepthLimits object
+    """
+    import target
+    if filename not in _depth_limits:
+        _depth_limits[filename] = target.DepthLimits().load(filename)
+    return _depth_limits[filename]
+
+
 class UndefinedEndDateError(Exception):
     pass
 
@@ -91,28 +122,64 @@ def check_input_dates(args):
     return start, end
 
 
-def increment_total_night(start, interval, telescopes):
+# two sided quantiles of Student's t distribution for 1 to 30 degrees of freedom, at each confidence level allowed for
+# CONFIDENCE in settings.dat, and the normal quantile used above 30
+T_QUANTILES = {
+    0.9: [6.314, 2.920, 2.353, 2.132, 2.015, 1.943, 1.895, 1.860, 1.833, 1.812, 1.796, 1.782, 1.771, 1.761, 1.753,
+          1.746, 1.740, 1.734, 1.729, 1.725, 1.721, 1.717, 1.714, 1.711, 1.708, 1.706, 1.703, 1.701, 1.699, 1.697],
+    0.95: [12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228, 2.201, 2.179, 2.160, 2.145, 2.131,
+           2.120, 2.110, 2.101, 2.093, 2.086, 2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042],
+    0.99: [63.657, 9.925, 5.841, 4.604, 4.032, 3.707, 3.499, 3.355, 3.250, 3.169, 3.106, 3.055, 3.012, 2.977, 2.947,
+           2.921, 2.898, 2.878, 2.861, 2.845, 2.831, 2.819, 2.807, 2.797, 2.787, 2.779, 2.771, 2.763, 2.756, 2.750],
+}
+NORMAL_QUANTILES = {0.9: 1.645, 0.95: 1.960, 0.99: 2.576}
+
+
+def confidence_interval(values, confidence=0.95):
+    """
+    Mean of a set of values and the half width of the confidence interval on it, from Student's t distribution
+    :param values: Values from independent runs, at least two: list of floats
+    :param confidence: Confidence level of the interval, one of those in T_QUANTILES: float
+    :return: Mean and half width of the interval: floats
+    """
+    import math
+    import numpy as np
+    values = np.asarray(values, dtype=float)
+    n = len(values)
+    quantiles = T_QUANTILES[confidence]
+    t = quantiles[n - 2] if n - 1 <= len(quantiles) else NORMAL_QUANTILES[confidence]
+    return float(np.mean(values)), t * float(np.std(values, ddof=1)) / math.sqrt(n)
+
+
+def increment_total_night(start, interval, telescopes, nights=None, weather=None):
     """
     Keep a running total of the total available observing hours through out simulation by calculating sunset and
     rise for each day in specified window
     :param telescopes:
     :param start: Start of window: datetime
     :param interval: Length of window: datetime
+    :param nights: Table of sunset/sunrise times for the run, computed directly if not given: NightEphemeris
+    :param weather: Weather at each site on each night of the run, giving the clear time directly, otherwise the
+                    night time is weighted by the chance of clear weather: NightWeather
+    :return: Total night time, and total clear night time, in days: floats
     """
     from datetime import timedelta
-    import mini_staralt
+    import ephemeris
+    import timeconv
 
     end = start + interval
     day = timedelta(days=1)
-    total_night_interval = timedelta(days=0)
-    clear_night_interval = timedelta(days=0)
+    if weather is not None:
+        return weather.night_time(telescopes, timeconv.to_mjd(start), -(-interval // day))  # nights in the window
+    total_night_interval = 0
+    clear_night_interval = 0
     while start < end:
-        for telescope in telescopes:  # calculate sunset/rise at each site
-            sunset, sunrise = mini_staralt.sun_set_rise(start, lon=telescope.lon, lat=telescope.lat,
-                                                        sundown=-12)
+        midnight = timeconv.to_mjd(start)
+        month = start.month - 1  # index into each site's monthly weather
+        for telescope in telescopes:  # look up sunset/rise at each site
+            sunset, sunrise = ephemeris.sun_set_rise(nights, midnight, telescope, sundown=-12)
             duration = (sunrise - sunset)*telescope.copies
             total_night_interval += duration  # add duration to counter
-            month = start.strftime('%B')
             clear_night_interval += duration * telescope.weather[month]
             #print(f'Clear: {clear_night_interval}')
         start += day  # increment day
@@ -1,13 +1,20 @@
 import mini_staralt
-import datetime
+import ephemeris
 import numpy as np
-from datetime import timedelta
+import timeconv
+import tools
 
 class Transit:
     """
     Transit object, contains information of individual transits, can calculate whether it is visible from specified
-    telescopes
+    telescopes. Times are held as float MJD (JD - 2400000) and durations in days
     """
+    __slots__ = ('date', 'name', 'center', 'ingress', 'egress', 'duration', 'ra', 'dec', 'rise_set_lst', 'period',
+                 'epoch', 'ingress_visible', 'egress_visible', 'visible_fraction', 'visible_from', 'visible_until',
+                 'scheduled', 'magnitude', 'depth', 'telescope', 'visible_tels', 'priority', 'target_rise',
+                 'target_set', 'sunset', 'sunrise', 'visible', 'moon_phase', 'moon_alt', 'cheap_moon',
+                 'days_to_next_visible', 'days_to_next_full', 'visible_in_next_30', 'run_start', 'run_end', 'series')
+
     def __init__(self):
         """
         Null constructor
@@ -20,6 +27,7 @@ class Transit:
         self.duration = None
         self.ra = None
         self.dec = None
+        self.rise_set_lst = {}
         self.period = None
         self.epoch = None
         self.ingress_visible = None
@@ -60,31 +68,29 @@ class Transit:
         Changes string output based on the number of telescopes a transit is observable from
         :return: Output string
         """
+        ingress, center, egress = (str(timeconv.from_mjd(x)) for x in (self.ingress, self.center, self.egress))
         if len(self.telescope) == 1:
-            return self.name + ' ' + self.telescope[0] + ' In/Cen/Eg: ' + str(self.ingress) + ' ' + str(
-                self.center) + ' ' + str(self.egress)
+            return self.name + ' ' + self.telescope[0] + ' In/Cen/Eg: ' + ingress + ' ' + center + ' ' + egress
         elif len(self.telescope) > 3:
-            return self.name + ' ' + self.telescope + ' In/Cen/Eg: ' + str(self.ingress) + ' ' + str(
-                self.center) + ' ' + str(self.egress)
+            return self.name + ' ' + self.telescope + ' In/Cen/Eg: ' + ingress + ' ' + center + ' ' + egress
         else:
             start = self.name+' '
             for single in self.telescope:
                 start += single+' '
-            start += 'In/Cen/Eg: '+str(self.ingress)+' '+str(self.center)+' '+str(self.egress)
+            start += 'In/Cen/Eg: '+ingress+' '+center+' '+egress
             return start
 
     def init_for_forecast(self, values_dict, ephemeris, epoch):
         """
         Fills a transit object from the predicted ephemeris and epoch, and target information from a Target object
         :param values_dict: dictionary of variables from Target object: dict
-        :param ephemeris: expected ephemeris for the transit: datetime
+        :param ephemeris: expected ephemeris for the transit: float MJD
         :param epoch: epoch of transit being forecast: int
         :return: Filled Transit object
         """
-        from datetime import timedelta
         self.name = values_dict['name']
         self.center = ephemeris
-        self.duration = timedelta(minutes=values_dict['duration'])
+        self.duration = values_dict['duration']/24/60  # minutes to days
         # calculate ingress and egress from predicted ephemeris and transit duration
         self.ingress = ephemeris - self.duration/2
         self.egress = ephemeris + self.duration/2
@@ -92,6 +98,7 @@ class Transit:
 
         self.ra = float(values_dict['ra'])
         self.dec = float(values_dict['dec'])
+        self.rise_set_lst = values_dict['rise_set_lst']
 
         self.depth = float(values_dict['depth'])
         self.period = float(values_dict['period'])
@@ -100,43 +107,50 @@ class Transit:
 
         return self
 
-    def obtain_sun_set_rise(self, telescope):
-        self.sunset, self.sunrise = mini_staralt.sun_set_rise(
-            self.center.replace(hour=0, second=0, minute=0, microsecond=0), lon=telescope.lon, lat=telescope.lat,
-            sundown=-20)
-        #self.sunset, self.sunrise = sunset, sunrise
+    def obtain_sun_set_rise(self, telescope, nights=None):
+        """
+        Finds the sunset and sunrise either side of the transit center
+        :param telescope: Telescope object for the site
+        :param nights: Table of sunset/sunrise times for the run, computed directly if not given: NightEphemeris
+        """
+        midnight = np.floor(self.center - 0.5) + 0.5  # MJD is JD - 2400000, so days start at .5
+        self.sunset, self.sunrise = ephemeris.sun_set_rise(nights, midnight, telescope, sundown=-20)
         # if calculation made for wrong day, step back and recalculate
         if self.sunset > self.center:
-            self.sunset, self.sunrise = mini_staralt.sun_set_rise(
-                self.center.replace(hour=0, second=0, minute=0, microsecond=0) - datetime.timedelta(
-                    days=1),
-                lon=telescope.lon, lat=telescope.lat, sundown=-20)
-        #return sunset, sunrise
+            self.sunset, self.sunrise = ephemeris.sun_set_rise(nights, midnight - 1, telescope, sundown=-20)
 
     def obtain_target_rise_set(self, telescope):
-        try:
-            # calculate target rise/set times
-            self.target_rise, self.target_set = mini_staralt.target_rise_set(
-                self.center.replace(hour=0, minute=0, second=0, microsecond=0),
-                ra=self.ra, dec=self.dec, mintargetalt=30, lon=telescope.lon, lat=telescope.lat)
-
-            # if calculation made for wrong day, step back and recalculate
-            if self.target_rise > self.center:
-                self.target_rise, self.target_set = mini_staralt.target_rise_set(
-                    self.center.replace(hour=0, minute=0, second=0, microsecond=0) - datetime.timedelta(
-                        days=1),
-                    ra=self.ra, dec=self.dec, mintargetalt=30, lon=telescope.lon, lat=telescope.lat)
-
-        except mini_staralt.NeverVisibleError:
-            self.target_rise = datetime.datetime(year=1, month=1, day=1, hour=0, minute=0, second=0)
-            self.target_set = datetime.datetime(year=1, month=1, day=1, hour=0, minute=0, second=1)
-        except mini_staralt.AlwaysVisibleError:
+        """
+        Finds the most recent rise of the target above 30 degrees at or before the transit center, and the following
+        set, from the sidereal rise time and time above 30 degrees for the site
+        :param telescope: Telescope object for the site
+        """
+        rise_lst, up_hours = self.get_rise_set_lst(telescope)
+        if up_hours <= 0:
+            # target is never visible
+            self.target_rise = -np.inf
+            self.target_set = -np.inf
+        elif up_hours >= 24:
             # target is always visible
             self.target_rise = self.sunset
             self.target_set = self.sunrise
-            # self.telescope.append(telescope.name)
+        else:
+            # only the conversion from sidereal time to UTC depends on the night
+            since_rise, up_solar = mini_staralt.get_last_rise(self.center + timeconv.MJD_OFFSET, rise_lst, up_hours,
+                                                              telescope.lon)
+            self.target_rise = self.center - float(since_rise)/24
+            self.target_set = self.target_rise + float(up_solar)/24
 
-        #return target_rise, target_set
+    def get_rise_set_lst(self, telescope):
+        """
+        Sidereal rise time and sidereal hours above 30 degrees at the site, from the Target if already calculated
+        :param telescope: Telescope object for the site
+        :return: Rise LST and hours above 30 degrees: floats
+        """
+        try:
+            return self.rise_set_lst[telescope.name]
+        except KeyError:
+            return mini_staralt.target_rise_set_lst(self.ra, self.dec, telescope.lat, mintargetalt=30)
 
     def check_visibility_limits(self):
         if self.sunset >= self.target_rise:
@@ -173,23 +187,81 @@ class Transit:
         else:
             self.visible = False
 
+    def reset_visibility(self):
+        """
+        Clears the results of a previous visibility check, so the same Transit can be checked against another site
+        """
+        self.ingress_visible = None
+        self.egress_visible = None
+        self.visible_fraction = None
+        self.visible = None
+        self.cheap_moon = None
+        self.telescope = []
+
     def check_transit_visibility(self, telescope, settings):
         """
-        Checks visibility of a Transit object from the Telescope, adds suitable sites to container
+        Checks visibility of a Transit object from the Telescope, adds suitable sites to container. The checks run as
+        a pipeline, cheapest first, stopping at the first stage that rules the transit out, and rejections are counted
+        per stage in settings.visibility_stats if it is set
         :param telescope: Telescope object for telescope being tested
+        :param settings: Settings object for the current run
+        """
+        self.reset_visibility()
+        forced = 'HIP41378' in self.name  # always scheduled, so evaluate every stage to fill in its details
+        stages = (('never_up', self.stage_ever_up), ('daytime', self.stage_night), ('target_down', self.stage_target_up),
+                  ('gress', self.stage_gress), ('moon', self.stage_moon))
+        rejected = None
+        for stage, check in stages:
+            if not check(telescope, settings) and rejected is None:
+                rejected = stage
+                if not forced:
+                    break
+
+        if rejected is None:
+            self.telescope = telescope.name
+        else:
+            self.visible = False
+        if forced:
+            self.telescope = telescope.name
+        if settings.visibility_stats is not None:
+            settings.visibility_stats.record(rejected)
+
+    def stage_ever_up(self, telescope, settings):
+        """
+        Visibility stage: the target rises above 30 degrees at the site at all
+        """
+        return self.get_rise_set_lst(telescope)[1] > 0
+
+    def stage_night(self, telescope, settings):
+        """
+        Visibility stage: the transit center is at night, which any transit with over half its duration visible needs
+        """
+        self.obtain_sun_set_rise(telescope, settings.nights)
+        return self.sunset < self.center < self.sunrise
+
+    def stage_target_up(self, telescope, settings):
+        """
+        Visibility stage: the target is above 30 degrees at night at the transit center
         """
-        self.obtain_sun_set_rise(telescope)
         self.obtain_target_rise_set(telescope)
         self.check_visibility_limits()
+        return self.visible_from < self.center < self.visible_until
+
+    def stage_gress(self, telescope, settings):
+        """
+        Visibility stage: ingress and egress, or enough of the transit if partial transits are allowed, are visible
+        """
         self.check_gress_visible(settings.partial)
-        self.check_moon(telescope)
+        return bool(self.visible)
+
+    def stage_moon(self, telescope, settings):
+        """
+        Visibility stage: moon phase and altitude requirements
+        """
+        self.check_moon(telescope, settings.moon)
         if self.moon_phase > settings.moon_phase and self.moon_alt > settings.moon_alt:
             self.cheap_moon = True
-
-        if self.visible and self.cheap_moon:
-            self.telescope = telescope.name
-        if 'HIP41378' in self.name:
-            self.telescope = telescope.name
+        return bool(self.cheap_moon)
 
     def calculate_priority(self, target):
         """
@@ -198,16 +270,15 @@ class Transit:
         :param target: Target object
         :return:
         """
-        import julian
-        from _datetime import datetime, timedelta
+        from datetime import datetime
         counter = 0
-        print(target.name, self.center)
+        print(target.name, timeconv.from_mjd(self.center))
         # only visible from 1 telescope
         if self.visible_tels == 1:
             counter += 2
             # print('single')
         # last observation is over 2 years old
-        if datetime.today() - julian.from_jd(target.last_tmid + 2400000, fmt='jd') > timedelta(days=730):
+        if timeconv.to_mjd(datetime.today()) - target.last_tmid > 730:
             counter += 1
             # print('old')
         # high current error, currently all targets, as only selecting those that have expired
@@ -219,9 +290,21 @@ class Transit:
             counter += 2
         self.priority = counter
 
-    def check_moon(self, telescope):
-        self.moon_phase = round(mini_staralt.get_moon_phase(self.center), 3)
-        self.moon_alt = mini_staralt.get_moon_alt(self.center, telescope)
+    def check_moon(self, telescope, moon=None):
+        """
+        Finds the moon phase and altitude at the transit center
+        :param telescope: Telescope object for the site
+        :param moon: Grid of moon phase and position for the run, computed directly if not given: MoonEphemeris
+        """
+        jd = self.center + timeconv.MJD_OFFSET
+        if moon is not None and moon.covers(jd):
+            # phase and position are shared by all sites, only the altitude is site dependent
+            self.moon_phase = round(float(moon.get_phase(jd)), 3)
+            moon_ra, moon_dec = moon.get_position(jd)
+            self.moon_alt = float(mini_staralt.get_alt(jd, moon_ra, moon_dec, telescope.lon, telescope.lat))
+        else:
+            self.moon_phase = round(mini_staralt.get_moon_phase(self.center), 3)
+            self.moon_alt = mini_staralt.get_moon_alt(self.center, telescope)
 
     def determine_strategy(self, strategy_data):
         telescope = None
@@ -233,14 +316,183 @@ class Transit:
             try:
 
                 strategy = strategy_data[f'{self.name}_{telescope}']
-                self.run_start = self.center + timedelta(minutes=strategy['start_time'])
-                self.run_end = self.center + timedelta(minutes=strategy['end_time'])
+                self.run_start = self.center + strategy['start_time']/24/60
+                self.run_end = self.center + strategy['end_time']/24/60
                 self.series = strategy['series']
             except KeyError:
                 pass
 
 
+class VisibilityStats:
+    """
+    Counts of candidate transits checked by Transit.check_transit_visibility, and how many each stage rejected. The
+    season stage counts those skipped by Target.transit_forecast using the seasonal visibility index. Transits read
+    from a transit catalogue are counted as well, where the never_up, daytime and target_down stages are counted
+    together as night_up, as the catalogue only holds the transits that passed them
+    """
+    STAGES = ('season', 'never_up', 'daytime', 'target_down', 'gress', 'moon')
+
+    def __init__(self):
+        """
+        Zeroed counters
+        """
+        self.checked = 0
+        self.accepted = 0
+        self.rejected = {stage: 0 for stage in self.STAGES + ('night_up',)}
+
+    def __str__(self):
+        stages = self.STAGES if self.rejected['night_up'] == 0 else self.STAGES + ('night_up',)
+        counts = ', '.join(f'{stage}: {self.rejected[stage]}' for stage in stages)
+        return f'Checked {self.checked}, accepted {self.accepted}, rejected by {counts}'
+
+    def record(self, stage, count=1):
+        """
+        Records the result of one or more visibility checks
+        :param stage: Name of the stage that rejected the transits, None if they were accepted
+        :param count: Number of transits: int
+        """
+        self.checked += count
+        if stage is None:
+            self.accepted += count
+        else:
+            self.rejected[stage] += count
+
+
+class TransitTable:
+    """
+    Struct-of-arrays container for forecast transits, one row per transit and site it is visible from. Rows are
+    appended from a Transit while forecasting, and the columns converted to arrays once with finalise
+    """
+    FLOAT_COLUMNS = ('center', 'ingress', 'egress', 'duration', 'ra', 'dec', 'depth', 'period', 'magnitude',
+                     'sunset', 'sunrise', 'target_rise', 'target_set', 'visible_from', 'visible_until',
+                     'visible_fraction', 'moon_phase', 'moon_alt')
+    INT_COLUMNS = ('epoch', 'priority')
+    BOOL_COLUMNS = ('ingress_visible', 'egress_visible', 'scheduled')
+    STR_COLUMNS = ('name', 'telescope')
+    COLUMNS = FLOAT_COLUMNS + INT_COLUMNS + BOOL_COLUMNS + STR_COLUMNS
+
+    def __init__(self):
+        """
+        Empty table, ready for appending
+        """
+        self.columns = {column: [] for column in self.COLUMNS}
+        self.final = False
+
+    def __len__(self):
+        return len(self.columns['center'])
+
+    def __getattr__(self, item):
+        """
+        Gives access to columns as attributes, table.center etc.
+        """
+        try:
+            return self.__dict__['columns'][item]
+        except KeyError:
+            raise AttributeError(item)
+
+    def append(self, transit):
+        """
+        Adds a row for the current site's visibility results stored in a Transit
+        :param transit: Transit object that has been checked for visibility
+        """
+        for column in self.COLUMNS:
+            self.columns[column].append(getattr(transit, column))
+
+    @staticmethod
+    def row_values(transit):
+        """
+        Values a Transit would add as a row, in column order, for adding again later with append_values
+        :param transit: Transit object that has been checked for visibility
+        :return: tuple
+        """
+        return tuple(getattr(transit, column) for column in TransitTable.COLUMNS)
+
+    def append_values(self, values):
+        """
+        Adds a row from values in column order
+        :param values: Values from row_values
+        """
+        for column, value in zip(self.COLUMNS, values):
+            self.columns[column].append(value)
+
+    def finalise(self):
+        """
+        Converts the columns to arrays, after which no more rows can be appended
+        :return: Finalised TransitTable
+        """
+        if not self.final:
+            for column in self.FLOAT_COLUMNS:
+                self.columns[column] = np.array(self.columns[column], dtype=float)
+            for column in self.INT_COLUMNS:
+                self.columns[column] = np.array(self.columns[column], dtype=int)
+            for column in self.BOOL_COLUMNS:
+                self.columns[column] = np.array(self.columns[column], dtype=bool)
+            for column in self.STR_COLUMNS:
+                self.columns[column] = np.array(self.columns[column], dtype=object)
+            self.final = True
+        return self
 
+    def select(self, rows):
+        """
+        Takes a subset of rows
+        :param rows: Boolean mask or indices of the rows to keep
+        :return: New TransitTable containing those rows
+        """
+        subset = TransitTable()
+        subset.columns = {column: values[rows] for column, values in self.finalise().columns.items()}
+        subset.final = True
+        return subset
 
+    def sort(self, column):
+        """
+        Orders the rows by a column, keeping the existing order of equal values
+        :param column: Name of the column to sort by
+        :return: New sorted TransitTable
+        """
+        return self.select(np.argsort(self.finalise().columns[column], kind='stable'))
 
+    def group_by(self, column):
+        """
+        Splits the table by the values of a column in a single pass, keeping the existing order within each part
+        :param column: Name of the column to group by
+        :return: Dictionary of value to new TransitTable containing those rows
+        """
+        return {value: self.select(rows) for value, rows in tools.group_rows(self.finalise().columns[column]).items()}
 
+    def row(self, index):
+        """
+        Lightweight read-only view of one row, usable in place of a Transit when scheduling
+        :param index: Row number
+        :return: TransitRow
+        """
+        return TransitRow(self, index)
+
+    def to_transits(self):
+        """
+        Builds a Transit object for each row, for output
+        :return: List of Transit objects
+        """
+        transits = []
+        for i in range(len(self)):
+            single = Transit()
+            for column, values in self.finalise().columns.items():
+                setattr(single, column, values[i])
+            transits.append(single)
+        return transits
+
+
+class TransitRow:
+    """
+    View of a single row of a TransitTable, with columns as attributes
+    """
+    __slots__ = ('table', 'index')
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+
+    def __getattr__(self, item):
+        try:
+            return self.table.columns[item][self.index]
+        except KeyError:
+            raise AttributeError(item)
@@ -0,0 +1,84 @@
+#################################################################
+# Clear or cloudy weather at each site on each night of a run,
+# drawn once at the start of the run, so whether an observation
+# is clear, and the clear time available, are looked up.
+#################################################################
+import numpy as np
+
+import timeconv
+
+
+class NightWeather:
+    """
+    Weather at each site on each night of the night table of a run, True where the night is clear. Night i starts on
+    the date nights.start_mjd + i, as in the night table. Each night is clear with the site's chance of clear weather
+    for that month, independently, or in runs of clear and cloudy nights if a correlation is given
+    """
+    def __init__(self):
+        """
+        Null constructor
+        """
+        self.sites = []
+        self.nights = None
+        self.clear = None
+        self.correlation = 0.
+
+    def build(self, telescopes, nights, rng, correlation=0.):
+        """
+        Draws the weather for every telescope on every night of the night table
+        :param telescopes: List of Telescope objects in the network
+        :param nights: Night table for the run: NightEphemeris
+        :param rng: Random number generator for the run: numpy Generator
+        :param correlation: Correlation between the weather on one night and the next at a site, from 0 for
+                            independent nights up to, but not including, 1: float
+        :return: Filled NightWeather object
+        """
+        self.sites = [telescope.name for telescope in telescopes]
+        self.nights = nights
+        self.correlation = correlation
+        months = timeconv.month_index(nights.start_mjd + np.arange(nights.n_nights))
+        chance = np.array([telescope.weather for telescope in telescopes]).reshape(len(telescopes), 12)[:, months]
+        draws = rng.random(chance.shape)
+        if correlation == 0:
+            self.clear = draws < chance
+        else:
+            # two state Markov chain at each site, which keeps the chance of a clear night at the monthly value, with a
+            # clear night more likely after a clear night and less likely after a cloudy one
+            self.clear = np.empty(chance.shape, dtype=bool)
+            self.clear[:, 0] = draws[:, 0] < chance[:, 0]
+            for night in range(1, nights.n_nights):
+                p = chance[:, night]
+                p_clear = np.where(self.clear[:, night - 1], p + correlation * (1 - p), p * (1 - correlation))
+                self.clear[:, night] = draws[:, night] < p_clear
+        return self
+
+    def is_clear(self, site_names, centers):
+        """
+        Looks up the weather for observations, on the night each one's center falls in
+        :param site_names: Name of the site of each observation: list of strings
+        :param centers: Center of each observation: float MJD array
+        :return: Whether each observation has clear weather: boolean array
+        """
+        rows = np.array([self.sites.index(name) for name in site_names], dtype=int)
+        night_rows = np.array([self.nights.sites.index(name) for name in site_names], dtype=int)
+        # the date the center falls on, or the one before if it is before that date's sunset
+        night = np.round(np.floor(centers - 0.5) + 0.5 - self.nights.start_mjd).astype(int)
+        night = np.where(self.nights.sunset[-20.][night_rows, night] > centers, night - 1, night)
+        return self.clear[rows, night]
+
+    def night_time(self, telescopes, start, n_nights):
+        """
+        Total night time, with the sun below -12 degrees, at the telescopes over a run of nights, and the part of it
+        that is clear, counting each copy of a telescope
+        :param telescopes: List of Telescope objects in the network
+        :param start: Date of the first night: float MJD
+        :param n_nights: Number of nights: int
+        :return: Total night time, and total clear night time, in days: floats
+        """
+        first = int(round(start - self.nights.start_mjd))
+        night_rows = [self.nights.sites.index(telescope.name) for telescope in telescopes]
+        rows = [self.sites.index(telescope.name) for telescope in telescopes]
+        copies = np.array([telescope.copies for telescope in telescopes])[:, np.newaxis]
+        duration = (self.nights.sunrise[-12.][night_rows, first:first + n_nights] -
+                    self.nights.sunset[-12.][night_rows, first:first + n_nights]) * copies
+        return float(np.sum(duration)), float(np.sum(duration * self.clear[rows, first:first + n_nights]))